@@ -3,12 +3,16 @@
 
 import argparse
 import collections
+import contextlib
 import json
 import os
 import logging
 
 import rdflib
 
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_SUFFIX = ".index.json"
+
 VOCABULARY = {
     "type": "http://www.w3.org/1999/02/22-rdf-syntax-ns#type",
     "Dataset": "http://www.w3.org/ns/dcat#Dataset",
@@ -23,7 +27,7 @@ def _parse_arguments():
     parser.add_argument("--input", required=True,
                         help="Path to DCAT-AP compatible TRIG.")
     parser.add_argument("--output", required=True,
-                        help="Path to output directory.")
+                        help="Path to output directory or .jsonl pack.")
     return vars(parser.parse_args())
 
 
@@ -53,17 +57,42 @@ def _create_parent_directory(path: str) -> None:
 
 
 def dcat_ap_trig_to_json(source_file: str, target_directory: str) -> None:
-    for index, rdf_as_str in enumerate(_for_each_graph(source_file)):
-        graph = rdflib.Graph()
-        graph.parse(data=rdf_as_str, format="trig")
-        dataset = _rdf_graph_to_dataset(graph)
-        if dataset is None:
-            continue
-        target_path = os.path.join(
-            target_directory,
-            str(index).zfill(6) + ".json")
-        with open(target_path, "w", encoding="utf-8") as output_stream:
-            json.dump(dataset, output_stream)
+    with _open_output_files(target_directory) as write_file:
+        for index, rdf_as_str in enumerate(_for_each_graph(source_file)):
+            graph = rdflib.Graph()
+            graph.parse(data=rdf_as_str, format="trig")
+            dataset = _rdf_graph_to_dataset(graph)
+            if dataset is None:
+                continue
+            write_file(str(index).zfill(6) + ".json", dataset)
+
+
+@contextlib.contextmanager
+def _open_output_files(output_path: str):
+    if not output_path.endswith(PACKED_EXTENSION):
+        def write_file(file_name: str, content) -> None:
+            output_file = os.path.join(output_path, file_name)
+            with open(output_file, "w", encoding="utf-8") as stream:
+                json.dump(content, stream)
+
+        yield write_file
+        return
+    # Packed files are JSON lines "[file_name, content]", the offset index
+    # of the lines is stored next to them.
+    offsets = {}
+    position = 0
+    with open(output_path, "wb") as stream:
+        def write_file(file_name: str, content) -> None:
+            nonlocal position
+            line = (json.dumps([file_name, content]) + "\n").encode("utf-8")
+            stream.write(line)
+            offsets[file_name] = position
+            position += len(line)
+
+        yield write_file
+    with open(output_path + PACKED_INDEX_SUFFIX, "w", encoding="utf-8") \
+            as stream:
+        json.dump(offsets, stream)
 
 
 def _for_each_graph(file: str):
@@ -8,11 +8,13 @@ import logging
 import typing
 import csv
 
+PACKED_EXTENSION = ".jsonl"
+
 
 def _parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--datasets", required=True,
-                        help="Path to directory with datasets.")
+                        help="Path to directory or .jsonl pack with datasets.")
     parser.add_argument("--similarity", required=True,
                         help="Path to CSV dataset similarity matrix file.")
     parser.add_argument("--csvWithIri", required=True,
@@ -202,13 +204,31 @@ def _select_property(
 
 
 def _iterate_input_files(input_directory: str):
-    for index, file_name in enumerate(os.listdir(input_directory)):
+    if _is_packed(input_directory):
+        with open(input_directory, "r", encoding="utf-8") as stream:
+            for index, line in enumerate(stream):
+                file_name, input_content = json.loads(line)
+                yield index, file_name, input_content
+        return
+    for index, file_name in enumerate(_list_input_files(input_directory)):
         input_file = os.path.join(input_directory, file_name)
         with open(input_file, "r", encoding="utf-8") as stream:
             input_content = json.load(stream)
         yield index, file_name, input_content
 
 
+def _list_input_files(input_directory: str) -> typing.List[str]:
+    # Hidden files, like the manifest of an incremental run, are skipped.
+    return [
+        file_name for file_name in os.listdir(input_directory)
+        if not file_name.startswith(".")
+    ]
+
+
+def _is_packed(path: str) -> bool:
+    return path.endswith(PACKED_EXTENSION)
+
+
 # endregion
 
 
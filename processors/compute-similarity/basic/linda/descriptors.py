@@ -1,5 +1,5 @@
 import re
-from typing import List, Set, Dict
+from typing import List, Set, Dict, Tuple
 import numpy as np
 from numba import jit
 
@@ -65,3 +65,32 @@ _DESCRIPTORS = {
 def descriptor_factory(name: str):
   assert name in _DESCRIPTORS, "Unknown descriptor type."
   return _DESCRIPTORS[name]
+
+
+def _descriptor_key(descriptor):
+  if isinstance(descriptor, np.ndarray):
+    return (descriptor.dtype.str, descriptor.shape, descriptor.tobytes())
+  if isinstance(descriptor, (set, frozenset)):
+    return frozenset(descriptor)
+  if isinstance(descriptor, dict):
+    return frozenset(descriptor.items())
+  if isinstance(descriptor, (list, tuple)):
+    return tuple(_descriptor_key(d) for d in descriptor)
+  return descriptor
+
+
+def deduplicate(descriptors: List) -> Tuple[List, np.ndarray]:
+  """
+  Returns unique descriptors in order of first occurrence and for every
+  descriptor the position of its unique descriptor.
+  """
+  positions = {}
+  unique = []
+  index = np.empty(len(descriptors), dtype=np.int64)
+  for i, descriptor in enumerate(descriptors):
+    key = _descriptor_key(descriptor)
+    if key not in positions:
+      positions[key] = len(unique)
+      unique.append(descriptor)
+    index[i] = positions[key]
+  return unique, index
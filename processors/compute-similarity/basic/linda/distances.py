@@ -56,7 +56,7 @@ def _cosine_v(vec1, vec2) -> float:
   if W1 == 0 or W2 == 0:
     return math.inf
   WW = np.sum(vec1*vec2)
-  return 1 - WW/math.sqrt(W1*W2)
+  return 1 - WW/np.sqrt(W1*W2)
 
 def _angle(words1: Dict[str, float], words2: Dict[str, float]) -> float:
   if len(words1) == 0 and len(words2) == 0:
@@ -74,7 +74,13 @@ def _angle_v(vec1, vec2) -> float:
   if W1 == 0 or W2 == 0:
     return math.inf
   WW = np.sum(vec1*vec2)
-  return math.acos(WW/math.sqrt(W1*W2))
+  C = WW/np.sqrt(W1*W2)
+  # Rounding, mostly in float32, can push the cosine out of the acos domain.
+  if C >= 1:
+    return 0.0
+  if C <= -1:
+    return math.pi
+  return math.acos(C)
 
 
 _FS = tlsh.FingerprintSimilarity()
@@ -112,6 +118,30 @@ def _hausdorff_sym(cont1, cont2, dist) -> float:
 def _hausdorff(cont1, cont2, dist) -> float:
   return _hausdorff_sym(cont1, cont2, dist)
 
+@jit(nopython=True)
+def _relaxed_wmd_uni(cont1, weights1, cont2, dist) -> float:
+  total = 0.0
+  for i in range(cont1.shape[0]):
+    dmin = math.inf
+    for i2 in cont2:
+      d = dist(cont1[i], i2)
+      if d < dmin:
+        dmin = d
+        if dmin == 0:
+          break
+    total += weights1[i] * dmin
+    if total == math.inf:
+      break
+  return total
+
+@jit(nopython=True)
+def _relaxed_wmd(cont1, weights1, cont2, weights2, dist) -> float:
+  # Each side moves all its weight to the nearest word of the other side,
+  # the larger of the two is a lower bound of the Word Mover's Distance.
+  lhs = _relaxed_wmd_uni(cont1, weights1, cont2, dist)
+  rhs = _relaxed_wmd_uni(cont2, weights2, cont1, dist)
+  return lhs if lhs > rhs else rhs
+
 _DISTANCES = {
   "levenshtein": _levenshtein,
   "jaccard": _jaccard,
@@ -136,3 +166,14 @@ class HausdorffDistance(object):
 def hausdorff_factory(name: str):
   assert name in _DISTANCES, "Unknown distance measure."
   return HausdorffDistance(_DISTANCES[name])
+
+class RelaxedWMDistance(object):
+  def __init__(self, distance):
+    self.distance = distance
+  
+  def __call__(self, d1, d2):
+    return _relaxed_wmd(d1[0], d1[1], d2[0], d2[1], self.distance)
+
+def relaxed_wmd_factory(name: str):
+  assert name in _DISTANCES, "Unknown distance measure."
+  return RelaxedWMDistance(_DISTANCES[name])
@@ -29,4 +29,4 @@ def _e_cosine_v(vec1, vec2) -> float:
   W1 = np.sum(vec1**2)
   W2 = np.sum(vec2**2)
   WW = np.sum(vec1*vec2)
-  return WW/math.sqrt(W1 * W2)
\ No newline at end of file
+  return WW/np.sqrt(W1 * W2)
\ No newline at end of file
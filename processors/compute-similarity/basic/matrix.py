@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import os
-import csv
 import argparse
 import logging
 import numpy as np
@@ -10,7 +9,8 @@ import json
 
 from tqdm import tqdm
 
-from linda.descriptors import descriptor_factory
+from linda.descriptors import descriptor_factory, deduplicate
+from descriptor_store import read_rows
 from linda.distances import distance_factory
 
 
@@ -27,21 +27,38 @@ def main():
     return 0
 
   logging.info("Loading descriptors ... [from %s]" % args["input"])
-  descriptors = load_descriptors_type(args["input"], args["input_header"], args["input_column"], descriptor_factory(args["type"]))
+  if args["input"].endswith(".npy") or args["input"].endswith(".npz"):
+    if args["type"] != "vector":
+      logging.error("Binary input contains only vector descriptors.")
+      return 1
+    descriptors = load_descriptors_vectors(args["input"])
+  else:
+    descriptors = load_descriptors_type(args["input"], args["input_header"], args["input_column"], descriptor_factory(args["type"]))
   if descriptors is None:
     logging.error("Error occured during descriptors loading.")
     return 1
   if len(descriptors) == 0:
     logging.warning("No descriptors were loaded.")
     return 0
+  # Native precision does not cast the vectors, they are used as loaded.
+  dtype = None if args["precision"] == "native" else np.dtype(args["precision"])
+  if dtype is not None:
+    descriptors = cast_descriptors(descriptors, dtype)
+
+  index = None
+  if args["deduplicate"]:
+    descriptors, index = deduplicate(descriptors)
+    logging.info("Unique descriptors: %s of %s" % (len(descriptors), len(index)))
   
   logging.info("Computing the distances for ...")
   distances = distance_matrix(descriptors, distance_factory(args["distance"]))
+  if index is not None:
+    distances = expand_distances(distances, index)
 
   if args["output"].endswith(".npy"):
-    np.save(args["output"], np.array(distances))
+    np.save(args["output"], np.array(distances, dtype=dtype))
   elif args["output"].endswith(".csv"):
-    np.savetxt(args["output"], np.array(distances), delimiter=',')
+    np.savetxt(args["output"], np.array(distances, dtype=dtype), delimiter=',')
   elif args["output"].endswith(".json"):
     with open(args["output"], "w") as output_stream:
       output_stream.write(json.dumps(distances) + '\n')
@@ -59,7 +76,7 @@ def read_configuration():
   
   parser.add_argument("-i", "--in", "--input",
     type=str, dest="input", required=True,
-    help="Path to input CSV file containing descriptors.")
+    help="Path to input CSV file containing descriptors, or .npy/.npz file with vectors.")
   parser.add_argument("--input-header",
     action="store_true", dest="input_header", required=False, default=False,
     help="Determines if the input CSV file has header.")
@@ -80,12 +97,24 @@ def read_configuration():
   parser.add_argument("-d", "--dist", "--distance",
     type=str, dest="distance", required=True,
     help="Distance measure.")
+  parser.add_argument("--precision",
+    type=str, dest="precision", required=False, default="native",
+    choices=["native", "float32", "float64"],
+    help="Floating point precision of vectors and distances.")
+
+  parser.add_argument("--deduplicate",
+    action="store_true", dest="deduplicate", required=False, default=False,
+    help="Compute distances only between unique descriptors.")
   
   args = vars(parser.parse_args())
 
   return args
 
 
+def cast_descriptors(descriptors, dtype):
+  return [ d.astype(dtype, copy=False) if isinstance(d, np.ndarray) else d for d in descriptors ]
+
+
 def distance_matrix(descriptors, distance):
   result = []
   for d1 in tqdm(descriptors):
@@ -93,21 +122,39 @@ def distance_matrix(descriptors, distance):
   return result
 
 
+def expand_distances(distances, index):
+  # Rows and columns of duplicate descriptors are copied from their unique
+  # descriptor.
+  return [ [ distances[i][j] for j in index ] for i in index ]
+
+
 def load_descriptors_type(input_path, input_header, input_column, convert):
   if not valid_file_for_read(input_path):
     return None
   
-  with open(input_path, encoding="UTF-8") as input_stream:
-    reader = csv.reader(input_stream)
+  descriptors = []
+  for row in read_rows(input_path, input_header):
+    descriptors.append(convert(row[1:] if input_column else row))
+  return descriptors
 
-    if input_header:
-      logging.debug("Skipping header info ...")
-      next(reader, None)
 
-    descriptors = []
-    for row in reader:
-      descriptors.append(convert(row[1:] if input_column else row))
-    return descriptors
+def load_descriptors_vectors(input_path):
+  # Vectors written by vectorize.py, rows without a vector are masked out.
+  if not valid_file_for_read(input_path):
+    return None
+
+  if input_path.endswith(".npz"):
+    archive = np.load(input_path)
+    vectors, mask = archive["vectors"], archive["mask"]
+  else:
+    index_path = input_path[:-len(".npy")] + ".index.npz"
+    if not valid_file_for_read(index_path):
+      return None
+    vectors = np.load(input_path, mmap_mode="r")
+    mask = np.load(index_path)["mask"]
+
+  empty = np.array([], dtype=vectors.dtype)
+  return [ vectors[i] if mask[i] else empty for i in range(vectors.shape[0]) ]
 
 
 def valid_file_for_read(file_path):
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import os
-import csv
 import argparse
 import logging
 import numpy as np
@@ -12,14 +11,20 @@ import multiprocessing as mp
 from functools import partial
 
 from tqdm import tqdm, trange
-from gensim.models import Word2Vec
+from gensim.models import Word2Vec, KeyedVectors
 
-from linda.descriptors import descriptor_factory
-from linda.distances import hausdorff_factory
+from linda.descriptors import descriptor_factory, deduplicate
+from descriptor_store import read_rows
+from linda.distances import hausdorff_factory, relaxed_wmd_factory
 
 
 CORES = max(1, mp.cpu_count())
 
+_SET_DISTANCES = {
+  "hausdorff": hausdorff_factory,
+  "rwmd": relaxed_wmd_factory,
+}
+
 def main():
   logging.basicConfig(
     level=logging.INFO,
@@ -29,6 +34,12 @@ def main():
   args = read_configuration()
   if args["parallel"]:
     logging.info("%s cores" % CORES)
+  # Native precision does not cast the vectors, they are used as loaded.
+  dtype = None if args["precision"] == "native" else np.dtype(args["precision"])
+  weighted = args["set_distance"] == "rwmd"
+  if weighted and not args["vectors"]:
+    logging.error("Relaxed Word Mover's Distance requires Word2Vec vectors.")
+    return 3
 
   if not valid_file_for_write(args["output"], args["rewrite"]):
     logging.warning("Existing output CSV file [%s] cannot be overrided." % args["output"])
@@ -43,29 +54,43 @@ def main():
     logging.warning("No descriptors were loaded.")
     return 0
 
+  index = None
+  if args["deduplicate"]:
+    # Equal descriptors have the same words, so they are also transformed
+    # into vectors only once.
+    descriptors, index = deduplicate(descriptors)
+    logging.info("Unique descriptors: %s of %s" % (len(descriptors), len(index)))
+
   if args["vectors"]:
     logging.info("Transforming words into vectors.")
-    model = Word2Vec.load(args["vectors"])
+    model = load_model(args["vectors"], args["keyed_vectors"])
     if not model:
       logging.error("Model cannot be loaded.")
       return 10
 
     for i in trange(len(descriptors)):
-      descriptors[i] = np.array(list(map(lambda w: model.wv[w] if w in model.wv else model.wv[w.lower()], filter(lambda w: len(w) > 0 and (w in model.wv or w.lower() in model.wv), descriptors[i]))))
-      if descriptors[i].shape[0] == 0:
-        descriptors[i] = np.array([[]]) 
+      words = list(filter(lambda w: len(w) > 0 and (w in model or w.lower() in model), descriptors[i]))
+      vectors = np.array(list(map(lambda w: model[w] if w in model else model[w.lower()], words)), dtype=dtype)
+      if vectors.shape[0] == 0:
+        vectors = np.array([[]], dtype=dtype) 
+      descriptors[i] = (vectors, word_weights(descriptors[i], words, vectors.dtype)) if weighted else vectors
+    # Release the model before the worker processes are forked.
+    del model
   
   logging.info("Computing the distances for ...")
   distances = None
+  distance = _SET_DISTANCES[args["set_distance"]](args["distance"])
   if args["parallel"]:
-    distances = distance_matrix_p(descriptors, hausdorff_factory(args["distance"]))
+    distances = distance_matrix_p(descriptors, distance)
   else:
-    distances = distance_matrix(descriptors, hausdorff_factory(args["distance"]))
+    distances = distance_matrix(descriptors, distance)
+  if index is not None:
+    distances = expand_distances(distances, index)
 
   if args["output"].endswith(".npy"):
-    np.save(args["output"], np.array(distances))
+    np.save(args["output"], np.array(distances, dtype=dtype))
   elif args["output"].endswith(".csv"):
-    np.savetxt(args["output"], np.array(distances), delimiter=',')
+    np.savetxt(args["output"], np.array(distances, dtype=dtype), delimiter=',')
   elif args["output"].endswith(".json"):
     with open(args["output"], "w") as output_stream:
       output_stream.write(json.dumps(distances) + '\n')
@@ -94,6 +119,9 @@ def read_configuration():
   parser.add_argument("-v", "--vectors",
     type=str, dest="vectors", required=False,
     help="Use vector file for Word2Vec.")
+  parser.add_argument("--keyed-vectors",
+    action="store_true", dest="keyed_vectors", required=False, default=False,
+    help="The vector file is keyed vectors file, load it memory-mapped.")
 
   parser.add_argument("-o", "--out", "--output",
     type=str, dest="output", required=True,
@@ -108,16 +136,42 @@ def read_configuration():
   parser.add_argument("-d", "--dist", "--distance",
     type=str, dest="distance", required=True,
     help="Distance measure.")
+  parser.add_argument("-s", "--set-distance",
+    type=str, dest="set_distance", required=False, default="hausdorff",
+    choices=list(_SET_DISTANCES.keys()),
+    help="Distance measure between sets of vectors.")
+  parser.add_argument("--precision",
+    type=str, dest="precision", required=False, default="native",
+    choices=["native", "float32", "float64"],
+    help="Floating point precision of vectors and distances.")
 
   parser.add_argument("--parallel",
     action="store_true", dest="parallel", required=False, default=False,
     help="Use more processes.")
+  parser.add_argument("--deduplicate",
+    action="store_true", dest="deduplicate", required=False, default=False,
+    help="Compute distances only between unique descriptors.")
   
   args = vars(parser.parse_args())
 
   return args
 
 
+def load_model(model_path, keyed_vectors = False):
+  if keyed_vectors:
+    return KeyedVectors.load(model_path, mmap="r")
+  return Word2Vec.load(model_path).wv
+
+
+def word_weights(descriptor, words, dtype = np.float64):
+  # Word frequencies are known only for words_count descriptor, words of
+  # other descriptors have the same weight.
+  if len(words) == 0:
+    return np.ones(1, dtype=dtype)
+  weights = np.array([ descriptor[w] if isinstance(descriptor, dict) else 1 for w in words ], dtype=dtype)
+  return weights / np.sum(weights)
+
+
 def distance_wrapper(distance, d1, d2):
   return distance(d1, d2)
 
@@ -138,21 +192,20 @@ def distance_matrix(descriptors, distance):
   return result
 
 
+def expand_distances(distances, index):
+  # Rows and columns of duplicate descriptors are copied from their unique
+  # descriptor.
+  return [ [ distances[i][j] for j in index ] for i in index ]
+
+
 def load_descriptors_type(input_path, input_header, input_column, convert):
   if not valid_file_for_read(input_path):
     return None
   
-  with open(input_path, encoding="UTF-8") as input_stream:
-    reader = csv.reader(input_stream)
-
-    if input_header:
-      logging.debug("Skipping header info ...")
-      next(reader, None)
-
-    descriptors = []
-    for row in reader:
-      descriptors.append(convert(row[1:] if input_column else row))
-    return descriptors
+  descriptors = []
+  for row in read_rows(input_path, input_header):
+    descriptors.append(convert(row[1:] if input_column else row))
+  return descriptors
 
 
 def valid_file_for_read(file_path):
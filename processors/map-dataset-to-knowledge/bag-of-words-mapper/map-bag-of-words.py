@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import json
 import os
 import logging
 import typing
 import argparse
+import contextlib
+import hashlib
+import multiprocessing
 import itertools
 import collections
+import sqlite3
 
 # For example "-" can be used to map to: Q11879093 or Q10689378, with "-"
 # as the only shared term. While we allow "-" to be used as a shared term it
@@ -18,22 +23,93 @@ INVALID_STANDALONE_MAPPING_TOKENS = {
     "(", ")", ".", "?", "!", "-", ",", "}", "{"
 }
 
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_SUFFIX = ".index.json"
+
+MANIFEST_FILE = ".manifest.json"
+
+# Number of rows inserted into, or tokens looked up in, the entities index
+# in one statement.
+INDEX_BATCH_SIZE = 500
+
+# Size of a part of knowledge file parsed by a worker in one task.
+SCAN_RANGE_SIZE = 16 * 1024 * 1024
+
+# Number of input files transformed by a worker in one task.
+CHUNK_SIZE = 100
+
+# Transformer and paths inherited by the forked workers, the transformer
+# is a closure over the loaded data, so it is never pickled.
+_WORKER = {}
+
+
+class EntityTable(typing.NamedTuple):
+    """
+    Entities sharing a token with the datasets. Tokens of entity labels are
+    interned to integer IDs, every label is stored as a tuple of token IDs,
+    so labels are tokenized only once and tokens are not duplicated.
+    """
+    # Token to its ID.
+    token_ids: typing.Dict[str, int]
+    # ID to its token.
+    tokens: typing.List[str]
+    # Entity IRI and token IDs of its labels, then aliases.
+    entities: typing.List[typing.Tuple[str, typing.Tuple]]
+    # Token to indexes of entities with the token, in order of the file.
+    token_to_entities: typing.Dict[str, typing.List[int]]
+    # Position of every entity in the entities file, entities are not
+    # always loaded in order of the file.
+    positions: typing.List[int]
+
 
 def _parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True,
-                        help="Path to input descriptor directory.")
+                        help="Path to input directory or .jsonl pack.")
     parser.add_argument("--output", required=True,
-                        help="Path to output descriptor directory.")
-    parser.add_argument("--entities", required=True,
+                        help="Path to output directory or .jsonl pack.")
+    parser.add_argument("--entities",
                         help="Path to JSONL files with entities.")
+    parser.add_argument("--entitiesIndex",
+                        help="Path to SQLite index of entities, created "
+                             "from --entities when missing or outdated.")
     parser.add_argument("--sourceProperty", required=True,
                         help="Name of a source property to transform.")
     parser.add_argument("--targetProperty", required=True,
                         help="Name of a property to store result into.")
     parser.add_argument("--sharedThreshold", type=float, default=0.6,
                         help="How many of entity tokens must be shared.")
-    return vars(parser.parse_args())
+    parser.add_argument("--matcher", default="overlap",
+                        choices=["overlap", "phrase", "phrase-overlap"],
+                        help="Map by shared tokens, by labels found in "
+                             "the text, or by both.")
+    parser.add_argument("--maxFanOut", type=int,
+                        help="Tokens of more entities only confirm mappings.")
+    parser.add_argument("--maxDocumentFrequency", type=float,
+                        help="Tokens in larger share of datasets only "
+                             "confirm mappings.")
+    parser.add_argument("--guardReport",
+                        help="Path to JSON file with the guarded tokens.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument("--ordered", action="store_true",
+                        help="Keep input order of files in packed output.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Transform only input files changed since "
+                             "the last run into the output directory.")
+    arguments = vars(parser.parse_args())
+    if arguments["incremental"] and _is_packed(arguments["output"]):
+        parser.error("--incremental requires an output directory.")
+    if arguments["entities"] is None and (
+            arguments["entitiesIndex"] is None
+            or not os.path.exists(arguments["entitiesIndex"])):
+        parser.error("--entities or an existing --entitiesIndex is required.")
+    if arguments["incremental"] and \
+            arguments["maxDocumentFrequency"] is not None:
+        # Document frequency depends on all datasets, not only the changed.
+        parser.error(
+            "--maxDocumentFrequency can not be used with --incremental.")
+    return arguments
 
 
 def main(arguments):
@@ -52,6 +128,9 @@ def _init_logging() -> None:
 
 
 def _create_directory(path: str) -> None:
+    if _is_packed(path):
+        # Packed output is a single file in the directory.
+        path = os.path.dirname(path)
     if path == "" or path == "." or path == "..":
         return
     os.makedirs(path, exist_ok=True)
@@ -60,42 +139,107 @@ def _create_directory(path: str) -> None:
 # endregion
 
 def create_mapping(arguments):
-    tokens = _load_tokens(arguments["input"], arguments["sourceProperty"])
-    token_to_entity = _load_wikidata_entities(arguments["entities"], tokens)
+    index = None
+    if arguments["entitiesIndex"] is not None:
+        index = _open_entities_index(
+            arguments["entitiesIndex"], arguments["entities"])
+    # Mapping of a file depends only on its own tokens, so the entities
+    # are loaded only for the files to transform.
+    manifest, selected = _prepare_incremental(arguments, lambda: {
+        "transformer": "bag-of-words-mapper",
+        "sourceProperty": arguments["sourceProperty"],
+        "targetProperty": arguments["targetProperty"],
+        "sharedThreshold": arguments["sharedThreshold"],
+        "matcher": arguments["matcher"],
+        "maxFanOut": arguments["maxFanOut"],
+        "entities": _entities_hash(arguments["entities"], index),
+    })
+    if selected is not None and not selected:
+        logging.info("No changed files, entities are not loaded.")
+        if index is not None:
+            index.close()
+        _save_manifest(arguments["output"], manifest)
+        return
+    document_frequency, documents = _load_tokens(
+        arguments["input"], arguments["sourceProperty"], selected)
+    tokens = document_frequency.keys()
+    if index is None:
+        entity_table = _load_wikidata_entities(
+            arguments["entities"], tokens, arguments["workers"])
+    else:
+        with contextlib.closing(index):
+            entity_table = _load_indexed_entities(index, tokens)
+
+    metadata = {
+        "transformer": "bag-of-words-mapper",
+        "from": arguments["sourceProperty"],
+        "threshold": arguments["sharedThreshold"],
+    }
+    guarded_tokens = set()
+    if arguments["maxFanOut"] is not None \
+            or arguments["maxDocumentFrequency"] is not None:
+        for key in ("maxFanOut", "maxDocumentFrequency"):
+            if arguments[key] is not None:
+                metadata[key] = arguments[key]
+        guarded_tokens = _guard_tokens(
+            entity_table, document_frequency, documents,
+            arguments["maxFanOut"], arguments["maxDocumentFrequency"],
+            arguments["guardReport"])
+    if arguments["matcher"] == "overlap":
+        def mapping_function(values):
+            return _mapping_function(
+                entity_table, values, arguments["sharedThreshold"])
+    else:
+        metadata["matcher"] = arguments["matcher"]
+        automaton = _create_phrase_automaton(
+            entity_table, tokens, guarded_tokens)
+
+        def mapping_function(values):
+            return _phrase_mapping_function(
+                entity_table, automaton, values,
+                arguments["sharedThreshold"],
+                arguments["matcher"] == "phrase-overlap")
 
     def file_transformer(content):
         _transform_dataset_property(
             arguments["sourceProperty"],
             arguments["targetProperty"],
             content,
-            {
-                "transformer": "bag-of-words-mapper",
-                "from": arguments["sourceProperty"],
-                "threshold": arguments["sharedThreshold"],
-            },
-            lambda values: _mapping_function(
-                token_to_entity, values, arguments["sharedThreshold"])
+            metadata,
+            mapping_function
         )
         return content
 
-    _transform_files(arguments["input"], arguments["output"], file_transformer)
+    _transform_files(
+        arguments["input"], arguments["output"], file_transformer,
+        arguments["workers"], arguments["ordered"], selected)
+    _save_manifest(arguments["output"], manifest)
 
 
-def _load_tokens(input_directory: str, source_property: str) -> typing.Set[str]:
+def _load_tokens(
+        input_directory: str, source_property: str,
+        selected: typing.Optional[typing.Set[str]] = None) \
+        -> typing.Tuple[typing.Counter[str], int]:
+    """
+    Return number of datasets with the token for every token, and number
+    of datasets.
+    """
     logging.info("Loading tokens ...")
-    tokens = set()
+    document_frequency = collections.Counter()
+    documents = 0
     index = 0
-    for index, _, content in _iterate_input_files(input_directory):
+    for index, _, content in _iterate_input_files(input_directory, selected):
         values, _ = _select_property(source_property, content)
-        for value in values:
-            for token in _tokenize(value):
-                tokens.add(token)
+        document_frequency.update({
+            token for value in values for token in _tokenize(value)
+        })
+        documents += 1
         if index % 1000 == 0:
             logging.info("    %s", index)
     logging.info("    %s", index)
-    logging.info("Tokens count: %s", len(tokens))
+    logging.info("Tokens count: %s", len(document_frequency))
     logging.info("Loading tokens ... done")
-    return tokens
+    return document_frequency, documents
 
 
 def _tokenize(value) -> typing.List[str]:
@@ -107,109 +251,589 @@ def _tokenize(value) -> typing.List[str]:
         return value.split(" ")
 
 
-def _load_wikidata_entities(wikidata_file: str, tokens: typing.Set[str]):
-    token_to_entity = collections.defaultdict(list)
+def _load_wikidata_entities(
+        wikidata_file: str, tokens: typing.AbstractSet[str],
+        workers: int = 1) \
+        -> EntityTable:
+    entity_table = _create_entity_table()
     logging.info("Loading entities ... ")
-    index = 0
-    shared_entities = 0
-    for index, entity in _iterate_json_lines(wikidata_file):
+
+    def select_entity(entity):
         entity_tokens = {
             token
-            for value in itertools.chain(
-                entity.get("label", []),
-                entity.get("aliases", [])
-            )
+            for value in _entity_labels(entity)
             for token in _tokenize(value)
         }
         shared_tokens = tokens & entity_tokens
-        for shared_token in shared_tokens:
-            token_to_entity[shared_token].append(entity)
-        if len(shared_tokens) > 0:
-            shared_entities += 1
-        if index % 100000 == 0:
-            logging.info("    %s", index)
-    logging.info("    %s", index)
-    logging.info("Shared tokens count: %s", len(token_to_entity))
-    logging.info("Mapped to entities count: %s", shared_entities)
+        if len(shared_tokens) == 0:
+            return None
+        # Most entities share no token, only the rest is kept.
+        labels = [_tokenize(value) for value in _entity_labels(entity)]
+        return entity["@id"], labels, shared_tokens
+
+    # Tokens are interned here, in order of the file, as the table is shared.
+    # The entities come in order of the file, their order is their position.
+    for position, (entity_id, labels, shared_tokens) in enumerate(
+            _scan_json_lines(wikidata_file, select_entity, workers)):
+        _add_entity(entity_table, entity_id, labels, shared_tokens, position)
+    _log_entity_table(entity_table)
     logging.info("Loading entities ... done")
-    return token_to_entity
+    return entity_table
+
+
+def _entity_labels(entity):
+    return itertools.chain(
+        entity.get("label", []),
+        entity.get("aliases", [])
+    )
+
+
+def _create_entity_table() -> EntityTable:
+    return EntityTable({}, [], [], collections.defaultdict(list), [])
+
+
+def _add_entity(
+        entity_table: EntityTable, entity_id: str,
+        labels: typing.List[typing.List[str]],
+        shared_tokens: typing.Iterable[str], position: int) -> int:
+    entity_index = len(entity_table.entities)
+    entity_table.entities.append((entity_id, tuple(
+        tuple(_intern_token(entity_table, token) for token in label)
+        for label in labels
+    )))
+    entity_table.positions.append(position)
+    for token in shared_tokens:
+        entity_table.token_to_entities[token].append(entity_index)
+    return entity_index
+
+
+def _intern_token(entity_table: EntityTable, token: str) -> int:
+    token_id = entity_table.token_ids.get(token, None)
+    if token_id is None:
+        token_id = len(entity_table.tokens)
+        entity_table.token_ids[token] = token_id
+        entity_table.tokens.append(token)
+    return token_id
+
+
+def _log_entity_table(entity_table: EntityTable) -> None:
+    logging.info(
+        "Shared tokens count: %s", len(entity_table.token_to_entities))
+    logging.info("Mapped to entities count: %s", len(entity_table.entities))
+    logging.info("Label tokens count: %s", len(entity_table.tokens))
 
 
-def _mapping_function(token_to_entity, values, shared_threshold):
+def _guard_tokens(
+        entity_table: EntityTable, document_frequency: typing.Counter[str],
+        documents: int, max_fan_out: typing.Optional[int],
+        max_document_frequency: typing.Optional[float],
+        report_file: typing.Optional[str]) -> typing.Set[str]:
+    """
+    Tokens with more entities than max_fan_out, or in larger share of
+    datasets than max_document_frequency, can not trigger a mapping. Their
+    entity lists are removed, with entities no longer referenced, but they
+    are still counted as shared tokens of a mapping.
+    """
+    logging.info("Guarding tokens ...")
+    report = []
+    for token, entities in entity_table.token_to_entities.items():
+        fan_out = len(entities)
+        frequency = document_frequency[token] / max(documents, 1)
+        if (max_fan_out is not None and fan_out > max_fan_out) or \
+                (max_document_frequency is not None
+                 and frequency > max_document_frequency):
+            report.append({
+                "token": token,
+                "fanOut": fan_out,
+                "documentFrequency": document_frequency[token],
+            })
+    report.sort(key=lambda item: (-item["fanOut"], item["token"]))
+    guarded_tokens = {item["token"] for item in report}
+    for token in guarded_tokens:
+        del entity_table.token_to_entities[token]
+    _remove_unreferenced_entities(entity_table)
+    logging.info("Guarded tokens count: %s", len(report))
+    for item in report[:10]:
+        logging.info(
+            "    %s fan-out: %s datasets: %s",
+            item["token"], item["fanOut"], item["documentFrequency"])
+    _log_entity_table(entity_table)
+    if report_file is not None:
+        _save_json_file(report_file, {
+            "documents": documents,
+            "maxFanOut": max_fan_out,
+            "maxDocumentFrequency": max_document_frequency,
+            "tokens": report,
+        })
+    logging.info("Guarding tokens ... done")
+    return guarded_tokens
+
+
+def _remove_unreferenced_entities(entity_table: EntityTable) -> None:
+    referenced = sorted({
+        entity_index
+        for entities in entity_table.token_to_entities.values()
+        for entity_index in entities
+    })
+    # Order of entities is kept, so order of the lists stays the same.
+    new_index = {
+        entity_index: position
+        for position, entity_index in enumerate(referenced)
+    }
+    entity_table.entities[:] = [
+        entity_table.entities[entity_index] for entity_index in referenced
+    ]
+    entity_table.positions[:] = [
+        entity_table.positions[entity_index] for entity_index in referenced
+    ]
+    for entities in entity_table.token_to_entities.values():
+        entities[:] = [new_index[entity_index] for entity_index in entities]
+
+
+def _mapping_function(
+        entity_table: EntityTable, values, shared_threshold: float,
+        resolved_entities: typing.Optional[typing.Set[str]] = None):
     """
     We require the wikidata entity to be in the given text, for
     entity "A B C" and text "0 A B C 1" we got match, but also
-    with "0 A 1 B 2 C" or "C B A".
+    with "0 A 1 B 2 C" or "C B A". Entities in resolved_entities are
+    skipped.
     """
-    # shared_for_entity = collections.defaultdict(list)
-    # entities = {}
-    # entities_shared_by_count = collections.Counter()
     result = []
-    resolved_entities = set()
+    if resolved_entities is None:
+        resolved_entities = set()
     for value in values:
         tokens = _tokenize(value)
+        # Tokens without ID are not in any label, so they can not be shared.
+        tokens_set = {
+            entity_table.token_ids[token] for token in tokens
+            if token in entity_table.token_ids
+        }
         for token in tokens:
             if token in INVALID_STANDALONE_MAPPING_TOKENS:
                 continue
-            for entity in token_to_entity.get(token, []):
-                entity_id = entity["@id"]
+            for entity_index in entity_table.token_to_entities.get(token, []):
+                entity_id, labels = entity_table.entities[entity_index]
                 if entity_id in resolved_entities:
                     continue
                 resolved_entities.add(entity_id)
-                mapping = _tokens_to_entity_mapping(tokens, entity,
-                                                    shared_threshold)
+                mapping = _tokens_to_entity_mapping(
+                    entity_table, tokens_set, entity_id, labels,
+                    shared_threshold)
                 if mapping is not None:
                     result.append(mapping)
     return result
 
 
 def _tokens_to_entity_mapping(
-        tokens: typing.List[str], entity, shared_threshold: int
+        entity_table: EntityTable, tokens_set: typing.Set[int],
+        entity_id: str, labels, shared_threshold: float
 ) -> typing.Optional:
     # ['ustav', '-', 'platny', '(', 'Usti', 'nad', 'Labe', '-', '2015', ')']
     # {'@id': 'Q44383619', 'label': [['Shenzhe', 'Open', '2015']]}
-    tokens_set = set(tokens)
-    best_shared, best_tokens = _tokens_to_shared_shared(
-        tokens_set, entity.get("label", []),
-        [], [],
-        shared_threshold)
-    best_shared, best_tokens = _tokens_to_shared_shared(
-        tokens_set, entity.get("aliases", []),
-        best_shared, best_tokens,
-        shared_threshold)
-    if len(best_shared) == 0:
+    # Labels and aliases are searched for the label with most shared tokens,
+    # the first one wins on a tie.
+    best_shared = 0
+    best_label = None
+    for token_ids in labels:
+        # Labels are short, so this is faster than a cached set of the IDs.
+        shared = len(tokens_set.intersection(token_ids))
+        if best_shared < shared and \
+                shared / len(token_ids) > shared_threshold:
+            best_shared = shared
+            best_label = token_ids
+    if best_label is None:
         return None
+    return _create_entity_mapping(
+        entity_table, tokens_set, entity_id, best_label)
+
+
+def _create_entity_mapping(
+        entity_table: EntityTable, tokens_set: typing.Set[int],
+        entity_id: str, best_label: typing.Tuple[int, ...]):
+    # Shared tokens are listed in order of the label.
     return {
-        "id": entity["@id"],
+        "id": entity_id,
         "metadata": {
-            "shared": best_shared,
-            "entity": best_tokens
+            "shared": [
+                entity_table.tokens[token_id]
+                for token_id in dict.fromkeys(best_label)
+                if token_id in tokens_set
+            ],
+            "entity": [
+                entity_table.tokens[token_id] for token_id in best_label
+            ]
         }
     }
 
 
-def _tokens_to_shared_shared(
-        tokens_set: typing.Set[str], values: typing.List[str],
-        best_shared: typing.List[str], best_tokens: typing.List[str],
-        shared_threshold: int):
-    for label in values:
-        label_tokens = _tokenize(label)
-        shared = list(set(label_tokens) & tokens_set)
-        if len(best_shared) < len(shared) and \
-                len(shared) / len(label_tokens) > shared_threshold:
-            best_shared = shared
-            best_tokens = label_tokens
-    return best_shared, best_tokens
+# region Phrase matcher
+
+class PhraseAutomaton(typing.NamedTuple):
+    """
+    Aho-Corasick automaton over token IDs of entity labels, it finds all
+    labels occurring in a text in one pass over the text.
+    """
+    # Transitions, the key is state << 32 | token ID, the root state is 0.
+    goto: typing.Dict[int, int]
+    # Failure transition of every state.
+    fail: typing.List[int]
+    # Index of the phrase ending in the state, or -1.
+    phrase: typing.List[int]
+    # Nearest state on the failure path with a phrase, or 0.
+    output: typing.List[int]
+    # Phrases as (entity index, label index) pairs sharing the label.
+    phrases: typing.List[typing.List[typing.Tuple[int, int]]]
+
+
+def _create_phrase_automaton(
+        entity_table: EntityTable, tokens: typing.AbstractSet[str],
+        guarded_tokens: typing.Set[str]) -> PhraseAutomaton:
+    logging.info("Creating phrase automaton ...")
+    automaton = PhraseAutomaton({}, [0], [-1], [0], [])
+    # Labels with a token not in the datasets can not be found, labels of
+    # only invalid or guarded tokens can not trigger a mapping.
+    invalid = {
+        entity_table.token_ids[token]
+        for token in INVALID_STANDALONE_MAPPING_TOKENS | guarded_tokens
+        if token in entity_table.token_ids
+    }
+    phrase_index = {}
+    for entity_index, (_, labels) in enumerate(entity_table.entities):
+        for label_index, token_ids in enumerate(labels):
+            if len(token_ids) == 0 or invalid.issuperset(token_ids):
+                continue
+            if any(entity_table.tokens[token_id] not in tokens
+                   for token_id in token_ids):
+                continue
+            phrase = phrase_index.get(token_ids, None)
+            if phrase is None:
+                phrase = _add_phrase(automaton, token_ids)
+                phrase_index[token_ids] = phrase
+            automaton.phrases[phrase].append((entity_index, label_index))
+    _add_failure_transitions(automaton)
+    logging.info("Phrases count: %s", len(automaton.phrases))
+    logging.info("States count: %s", len(automaton.fail))
+    logging.info("Creating phrase automaton ... done")
+    return automaton
+
+
+def _add_phrase(
+        automaton: PhraseAutomaton, token_ids: typing.Tuple[int, ...]) -> int:
+    state = 0
+    for token_id in token_ids:
+        key = state << 32 | token_id
+        next_state = automaton.goto.get(key, None)
+        if next_state is None:
+            next_state = len(automaton.fail)
+            automaton.goto[key] = next_state
+            automaton.fail.append(0)
+            automaton.phrase.append(-1)
+            automaton.output.append(0)
+        state = next_state
+    if automaton.phrase[state] == -1:
+        automaton.phrase[state] = len(automaton.phrases)
+        automaton.phrases.append([])
+    return automaton.phrase[state]
+
+
+def _add_failure_transitions(automaton: PhraseAutomaton) -> None:
+    children = collections.defaultdict(list)
+    for key, state in automaton.goto.items():
+        children[key >> 32].append((key & 0xFFFFFFFF, state))
+    # States are visited by depth, so failure of the parent is known.
+    queue = collections.deque([0])
+    while len(queue) > 0:
+        parent = queue.popleft()
+        for token_id, state in children.get(parent, []):
+            queue.append(state)
+            if parent == 0:
+                continue
+            fail = automaton.fail[parent]
+            while fail != 0 and (fail << 32 | token_id) not in automaton.goto:
+                fail = automaton.fail[fail]
+            fail = automaton.goto.get(fail << 32 | token_id, 0)
+            automaton.fail[state] = fail
+            automaton.output[state] = \
+                fail if automaton.phrase[fail] != -1 else automaton.output[fail]
+
+
+def _find_phrases(automaton: PhraseAutomaton, token_ids: typing.List[int]):
+    # Yield indexes of all phrases in the text, in order of their end.
+    state = 0
+    for token_id in token_ids:
+        if token_id < 0:
+            # Token is not in any label.
+            state = 0
+            continue
+        while state != 0 and \
+                (state << 32 | token_id) not in automaton.goto:
+            state = automaton.fail[state]
+        state = automaton.goto.get(state << 32 | token_id, 0)
+        if automaton.phrase[state] != -1:
+            yield automaton.phrase[state]
+        match = automaton.output[state]
+        while match != 0:
+            yield automaton.phrase[match]
+            match = automaton.output[match]
+
+
+def _phrase_mapping_function(
+        entity_table: EntityTable, automaton: PhraseAutomaton, values,
+        shared_threshold: float, overlap: bool):
+    """
+    Map to entities with a label, or an alias, found in the text as is,
+    for entity "A B C" and text "0 A B C 1" we got match, but not with
+    "0 A 1 B 2 C". With overlap the remaining entities are mapped
+    using shared tokens, as by _mapping_function.
+    """
+    result = []
+    resolved_entities = set()
+    for value in values:
+        tokens = _tokenize(value)
+        token_ids = [entity_table.token_ids.get(token, -1) for token in tokens]
+        # The label with most distinct tokens is used, the first on a tie.
+        best_labels = {}
+        for phrase in _find_phrases(automaton, token_ids):
+            for entity_index, label_index in automaton.phrases[phrase]:
+                best = best_labels.get(entity_index, None)
+                if best is None or \
+                        _phrase_order(entity_table, entity_index, label_index) \
+                        < _phrase_order(entity_table, entity_index, best):
+                    best_labels[entity_index] = label_index
+        tokens_set = set(token_ids)
+        # Entities are mapped in order of the file, not of the table, so the
+        # result does not depend on how the entities were loaded.
+        for entity_index, label_index in sorted(
+                best_labels.items(),
+                key=lambda item: entity_table.positions[item[0]]):
+            entity_id, labels = entity_table.entities[entity_index]
+            if entity_id in resolved_entities:
+                continue
+            resolved_entities.add(entity_id)
+            result.append(_create_entity_mapping(
+                entity_table, tokens_set, entity_id, labels[label_index]))
+    if overlap:
+        result.extend(_mapping_function(
+            entity_table, values, shared_threshold, resolved_entities))
+    return result
+
+
+def _phrase_order(
+        entity_table: EntityTable, entity_index: int, label_index: int):
+    labels = entity_table.entities[entity_index][1]
+    return -len(set(labels[label_index])), label_index
+
+
+# endregion
+
+# region Entities index
+
+def _open_entities_index(
+        index_file: str, wikidata_file: typing.Optional[str]) \
+        -> sqlite3.Connection:
+    """
+    Open index of entities, the index is created from the entities file
+    when it does not exist or the entities file has changed since.
+    """
+    if wikidata_file is not None and \
+            not _is_entities_index_valid(index_file, wikidata_file):
+        _create_entities_index(index_file, wikidata_file)
+    return sqlite3.connect(index_file)
+
+
+def _is_entities_index_valid(index_file: str, wikidata_file: str) -> bool:
+    if not os.path.exists(index_file):
+        return False
+    with contextlib.closing(sqlite3.connect(index_file)) as connection:
+        source = _read_index_metadata(connection, "source")
+    return source == _file_signature(wikidata_file)
+
+
+def _file_signature(path: str) -> str:
+    status = os.stat(path)
+    return "%s:%s" % (status.st_size, status.st_mtime_ns)
+
+
+def _entities_hash(
+        wikidata_file: str, index: typing.Optional[sqlite3.Connection]) -> str:
+    # The index stores hash of the entities file it was created from.
+    if index is None:
+        return _hash_file(wikidata_file)
+    return _read_index_metadata(index, "sha256")
 
 
+def _read_index_metadata(connection: sqlite3.Connection, key: str):
+    row = connection.execute(
+        "SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+    return None if row is None else row[0]
+
+
+def _create_entities_index(index_file: str, wikidata_file: str) -> None:
+    """
+    Entities are stored with pre-tokenized labels and aliases under their
+    line number in the entities file, tokens are indexed by entities that
+    contain them.
+    """
+    logging.info("Creating entities index ...")
+    source = _file_signature(wikidata_file)
+    digest = hashlib.sha256()
+    # The index is created under another name, so an interrupted run
+    # does not leave an incomplete index behind.
+    temporary_file = index_file + ".tmp"
+    if os.path.exists(temporary_file):
+        os.remove(temporary_file)
+    with contextlib.closing(sqlite3.connect(temporary_file)) as connection:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(
+            "CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute(
+            "CREATE TABLE entity (id INTEGER PRIMARY KEY, iri TEXT, "
+            "label TEXT, aliases TEXT)")
+        # Tokens are collected in a temporary table first, then inserted
+        # in order, which is faster than inserting into the index directly.
+        connection.execute(
+            "CREATE TEMP TABLE entity_token (token TEXT, entity INTEGER)")
+        entities = []
+        tokens = []
+        index = 0
+        with open(wikidata_file, "rb") as stream:
+            for index, line in enumerate(stream):
+                digest.update(line)
+                entity = json.loads(line)
+                label = [_tokenize(value) for value in entity.get("label", [])]
+                aliases = [
+                    _tokenize(value) for value in entity.get("aliases", [])]
+                entities.append((
+                    index, entity["@id"],
+                    json.dumps(label, ensure_ascii=False),
+                    json.dumps(aliases, ensure_ascii=False)))
+                tokens.extend(
+                    (token, index) for token in
+                    {token for value in label + aliases for token in value})
+                if len(entities) >= INDEX_BATCH_SIZE:
+                    _insert_entities(connection, entities, tokens)
+                    entities, tokens = [], []
+                if index % 100000 == 0:
+                    logging.info("    %s", index)
+        _insert_entities(connection, entities, tokens)
+        logging.info("    %s", index)
+        logging.info("Indexing tokens ...")
+        connection.execute(
+            "CREATE TABLE token (token TEXT, entity INTEGER, "
+            "PRIMARY KEY (token, entity)) WITHOUT ROWID")
+        connection.execute(
+            "INSERT INTO token SELECT token, entity FROM entity_token "
+            "ORDER BY token, entity")
+        connection.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("source", source),
+            ("sha256", digest.hexdigest()),
+        ])
+        connection.commit()
+    os.replace(temporary_file, index_file)
+    logging.info("Creating entities index ... done")
+
+
+def _insert_entities(connection: sqlite3.Connection, entities, tokens) \
+        -> None:
+    connection.executemany(
+        "INSERT INTO entity VALUES (?, ?, ?, ?)", entities)
+    connection.executemany(
+        "INSERT INTO entity_token VALUES (?, ?)", tokens)
+
+
+def _load_indexed_entities(
+        connection: sqlite3.Connection, tokens: typing.AbstractSet[str]) \
+        -> EntityTable:
+    # Same result as _load_wikidata_entities, entities of every token
+    # are in the order of the entities file.
+    entity_table = _create_entity_table()
+    # Line number of entity in the file to its index in the table.
+    entities = {}
+    logging.info("Loading entities from index ... ")
+    tokens = list(tokens)
+    for start in range(0, len(tokens), INDEX_BATCH_SIZE):
+        batch = tokens[start:start + INDEX_BATCH_SIZE]
+        rows = connection.execute(
+            "SELECT token.token, entity.id, entity.iri, entity.label, "
+            "entity.aliases FROM token JOIN entity ON token.entity = entity.id "
+            "WHERE token.token IN (%s) ORDER BY token.token, entity.id"
+            % ",".join("?" * len(batch)), batch)
+        for token, line, iri, label, aliases in rows:
+            entity_index = entities.get(line, None)
+            if entity_index is None:
+                entity_index = _add_entity(
+                    entity_table, iri,
+                    json.loads(label) + json.loads(aliases), [], line)
+                entities[line] = entity_index
+            entity_table.token_to_entities[token].append(entity_index)
+        if start % (100 * INDEX_BATCH_SIZE) == 0:
+            logging.info("    %s", start)
+    _log_entity_table(entity_table)
+    logging.info("Loading entities from index ... done")
+    return entity_table
+
+
+# endregion
+
 # region Knowledge graph
 
-def _iterate_json_lines(file_path: str) \
-        -> typing.Generator[typing.Tuple[int, object], None, None]:
-    with open(file_path, encoding="utf-8") as stream:
-        for index, line in enumerate(stream):
-            entity = json.loads(line)
-            yield index, entity
+def _scan_json_lines(file_path: str, select, workers: int = 1):
+    """
+    Yield results of select called on every line of a JSON lines file, in
+    order of the file, None results are skipped. The file is split into
+    byte ranges aligned to lines, with more workers the ranges are parsed
+    and selected in parallel, only the selected results are sent back.
+    """
+    byte_ranges = _split_to_byte_ranges(file_path, SCAN_RANGE_SIZE)
+    size = os.path.getsize(file_path)
+    _WORKER["select"] = select
+    _WORKER["scan"] = file_path
+    scanned = 0
+    with contextlib.ExitStack() as stack:
+        if workers > 1:
+            context = multiprocessing.get_context("fork")
+            pool = stack.enter_context(context.Pool(workers))
+            results = pool.imap(_scan_byte_range, byte_ranges)
+        else:
+            # Results are not collected, so only one entity is kept.
+            results = map(_iterate_byte_range, byte_ranges)
+        for (start, end), selected in zip(byte_ranges, results):
+            yield from selected
+            scanned += end - start
+            logging.info("    %s of %s bytes", scanned, size)
+
+
+def _split_to_byte_ranges(file_path: str, range_size: int) \
+        -> typing.List[typing.Tuple[int, int]]:
+    size = os.path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, "rb") as stream:
+        while boundaries[-1] + range_size < size:
+            # Range ends with the line containing its last byte.
+            stream.seek(boundaries[-1] + range_size)
+            stream.readline()
+            boundaries.append(stream.tell())
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _scan_byte_range(byte_range: typing.Tuple[int, int]) -> typing.List:
+    return list(_iterate_byte_range(byte_range))
+
+
+def _iterate_byte_range(byte_range: typing.Tuple[int, int]):
+    start, end = byte_range
+    select = _WORKER["select"]
+    with open(_WORKER["scan"], "rb") as stream:
+        stream.seek(start)
+        content = stream.read(end - start)
+    for line in io.BytesIO(content):
+        selected = select(json.loads(line))
+        if selected is not None:
+            yield selected
 
 
 # endregion
@@ -247,28 +871,300 @@ def _select_property(
 
 
 def _transform_files(
-        input_directory: str, output_directory: str, transformer) -> None:
+        input_directory: str, output_directory: str, transformer,
+        workers: int = 1, ordered: bool = False,
+        selected: typing.Optional[typing.Set[str]] = None) -> None:
+    # Only selected files are transformed, all when selected is None.
+    if workers > 1:
+        _transform_files_parallel(
+            input_directory, output_directory, transformer, workers, ordered,
+            selected)
+    else:
+        _transform_files_sequential(
+            input_directory, output_directory, transformer, selected)
+
+
+def _transform_files_sequential(
+        input_directory: str, output_directory: str, transformer,
+        selected: typing.Optional[typing.Set[str]]) -> None:
     logging.info("Transforming files ...")
     index = 0
-    for index, file_name, content in _iterate_input_files(input_directory):
-        result = transformer(content)
-        output_file = os.path.join(output_directory, file_name)
-        with open(output_file, "w", encoding="utf-8") as stream:
-            json.dump(result, stream)
-        if index % 1000 == 0:
-            logging.info("    %s", index)
+    with _open_output_files(output_directory) as write_file:
+        for index, file_name, content in \
+                _iterate_input_files(input_directory, selected):
+            write_file(file_name, transformer(content))
+            if index % 1000 == 0:
+                logging.info("    %s", index)
     logging.info("    %s", index)
     logging.info("Transforming files ... done")
 
 
-def _iterate_input_files(input_directory: str):
-    for index, file_name in enumerate(os.listdir(input_directory)):
+def _transform_files_parallel(
+        input_directory: str, output_directory: str, transformer,
+        workers: int, ordered: bool,
+        selected: typing.Optional[typing.Set[str]]) -> None:
+    logging.info("Transforming files with %s workers ...", workers)
+    _WORKER["transformer"] = transformer
+    _WORKER["input"] = input_directory
+    _WORKER["output"] = output_directory
+    index = 0
+    context = multiprocessing.get_context("fork")
+    with _open_output_files(output_directory) as write_file, \
+            context.Pool(workers) as pool:
+        chunks = _iterate_input_chunks(input_directory, selected)
+        if ordered:
+            results = pool.imap(_transform_chunk, chunks)
+        else:
+            results = pool.imap_unordered(_transform_chunk, chunks)
+        for count, serialized in results:
+            # Only the packed output is written here, workers write files.
+            for file_name, text in serialized:
+                write_file(file_name, text, serialized=True)
+            if index // 1000 != (index + count) // 1000:
+                logging.info("    %s", index + count)
+            index += count
+    logging.info("    %s", index)
+    logging.info("Transforming files ... done")
+
+
+def _iterate_input_chunks(
+        input_directory: str,
+        selected: typing.Optional[typing.Set[str]] = None):
+    # File names, or lines of a packed input, in chunks of CHUNK_SIZE.
+    if _is_packed(input_directory):
+        yield from _split_to_chunks(
+            _iterate_packed_lines(input_directory, selected))
+    else:
+        yield from _split_to_chunks(
+            _select_file_names(input_directory, selected))
+
+
+def _split_to_chunks(items):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, CHUNK_SIZE))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def _transform_chunk(chunk):
+    serialized = []
+    for item in chunk:
+        if _is_packed(_WORKER["input"]):
+            file_name, content = json.loads(item)
+        else:
+            file_name = item
+            input_file = os.path.join(_WORKER["input"], file_name)
+            with open(input_file, "r", encoding="utf-8") as stream:
+                content = json.load(stream)
+        text = json.dumps(_WORKER["transformer"](content))
+        if _is_packed(_WORKER["output"]):
+            serialized.append((file_name, text))
+            continue
+        output_file = os.path.join(_WORKER["output"], file_name)
+        with open(output_file, "w", encoding="utf-8") as stream:
+            stream.write(text)
+    return len(chunk), serialized
+
+
+@contextlib.contextmanager
+def _open_output_files(output_path: str):
+    if not _is_packed(output_path):
+        def write_file(
+                file_name: str, content, serialized: bool = False) -> None:
+            output_file = os.path.join(output_path, file_name)
+            with open(output_file, "w", encoding="utf-8") as stream:
+                if serialized:
+                    stream.write(content)
+                else:
+                    json.dump(content, stream)
+
+        yield write_file
+        return
+    # Packed files are JSON lines "[file_name, content]", the offset index
+    # of the lines is stored next to them.
+    offsets = {}
+    position = 0
+    with open(output_path, "wb") as stream:
+        def write_file(
+                file_name: str, content, serialized: bool = False) -> None:
+            nonlocal position
+            if serialized:
+                # Same as json.dumps of the list with the parsed content.
+                line = "[" + json.dumps(file_name) + ", " + content + "]\n"
+            else:
+                line = json.dumps([file_name, content]) + "\n"
+            line = line.encode("utf-8")
+            stream.write(line)
+            offsets[file_name] = position
+            position += len(line)
+
+        yield write_file
+    with open(output_path + PACKED_INDEX_SUFFIX, "w", encoding="utf-8") \
+            as stream:
+        json.dump(offsets, stream)
+
+
+def _iterate_input_files(
+        input_directory: str,
+        selected: typing.Optional[typing.Set[str]] = None):
+    if _is_packed(input_directory):
+        lines = _iterate_packed_lines(input_directory, selected)
+        for index, line in enumerate(lines):
+            file_name, input_content = json.loads(line)
+            yield index, file_name, input_content
+        return
+    file_names = _select_file_names(input_directory, selected)
+    for index, file_name in enumerate(file_names):
         input_file = os.path.join(input_directory, file_name)
         with open(input_file, "r", encoding="utf-8") as stream:
             input_content = json.load(stream)
         yield index, file_name, input_content
 
 
+def _iterate_packed_lines(
+        input_path: str, selected: typing.Optional[typing.Set[str]]):
+    offsets = None if selected is None else _load_packed_index(input_path)
+    if offsets is None:
+        with open(input_path, "r", encoding="utf-8") as stream:
+            yield from _select_lines(stream, selected)
+        return
+    # Only the selected lines are read, in order of the pack.
+    with open(input_path, "rb") as stream:
+        for offset in sorted(
+                offsets[file_name] for file_name in selected
+                if file_name in offsets):
+            stream.seek(offset)
+            yield stream.readline().decode("utf-8")
+
+
+def _load_packed_index(input_path: str) \
+        -> typing.Optional[typing.Dict[str, int]]:
+    # The index is written after the pack, an older one is outdated.
+    index_path = input_path + PACKED_INDEX_SUFFIX
+    if not os.path.exists(index_path) or \
+            os.path.getmtime(index_path) < os.path.getmtime(input_path):
+        return None
+    with open(index_path, "r", encoding="utf-8") as stream:
+        return json.load(stream)
+
+
+def _select_lines(lines, selected: typing.Optional[typing.Set[str]]):
+    for line in lines:
+        if selected is None or _packed_file_name(line) in selected:
+            yield line
+
+
+def _select_file_names(
+        input_directory: str, selected: typing.Optional[typing.Set[str]]) \
+        -> typing.List[str]:
+    # Hidden files, like the manifest of an incremental run, are skipped.
+    return [
+        file_name for file_name in os.listdir(input_directory)
+        if not file_name.startswith(".")
+        and (selected is None or file_name in selected)
+    ]
+
+
+def _packed_file_name(line: str) -> str:
+    # Only the file name at the start of the line is decoded.
+    file_name, _ = json.JSONDecoder().raw_decode(line, 1)
+    return file_name
+
+
+def _is_packed(path: str) -> bool:
+    return path.endswith(PACKED_EXTENSION)
+
+
+# endregion
+
+# region Incremental
+
+def _prepare_incremental(arguments, parameters):
+    """
+    Return manifest and names of files to transform, or None and None when
+    the run is not incremental. The parameters function is called only for
+    incremental runs, its result must contain everything the transformation
+    of a file depends on, except the file itself.
+    """
+    if not arguments["incremental"]:
+        return None, None
+    manifest = _create_manifest(arguments["input"], parameters())
+    return manifest, _select_changed_files(arguments["output"], manifest)
+
+
+def _save_manifest(output_directory: str, manifest) -> None:
+    if manifest is None:
+        return
+    _save_json_file(os.path.join(output_directory, MANIFEST_FILE), manifest)
+
+
+def _create_manifest(input_directory: str, parameters):
+    logging.info("Computing input hashes ...")
+    files = {}
+    if _is_packed(input_directory):
+        with open(input_directory, "r", encoding="utf-8") as stream:
+            for line in stream:
+                files[_packed_file_name(line)] = \
+                    _hash_bytes(line.encode("utf-8"))
+    else:
+        for file_name in _select_file_names(input_directory, None):
+            input_file = os.path.join(input_directory, file_name)
+            with open(input_file, "rb") as stream:
+                files[file_name] = _hash_bytes(stream.read())
+    logging.info("Computing input hashes ... done")
+    return {
+        "parameters": _hash_bytes(
+            json.dumps(parameters, sort_keys=True).encode("utf-8")),
+        "files": files,
+    }
+
+
+def _select_changed_files(output_directory: str, manifest) \
+        -> typing.Set[str]:
+    manifest_file = os.path.join(output_directory, MANIFEST_FILE)
+    previous = {"parameters": None, "files": {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as stream:
+            previous = json.load(stream)
+    # Outputs of deleted input files are removed.
+    for file_name in previous["files"]:
+        output_file = os.path.join(output_directory, file_name)
+        if file_name not in manifest["files"] \
+                and os.path.exists(output_file):
+            os.remove(output_file)
+    if previous["parameters"] != manifest["parameters"]:
+        logging.info("Parameters changed, transforming all files.")
+        return set(manifest["files"].keys())
+    selected = {
+        file_name
+        for file_name, file_hash in manifest["files"].items()
+        if previous["files"].get(file_name) != file_hash
+        or not os.path.exists(os.path.join(output_directory, file_name))
+    }
+    logging.info(
+        "Changed files: %s of %s", len(selected), len(manifest["files"]))
+    return selected
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hash_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def _save_json_file(path: str, content) -> None:
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+
+
 # endregion
 
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar binary descriptor store, an alternative to descriptor CSV files.
+
+A store file holds the same rows as a descriptor CSV file (`id,value,...`),
+the fields of all rows are concatenated into one UTF-8 blob. The layout is:
+
+- header: magic, number of rows, number of fields, blob size
+- blob: UTF-8 fields, each followed by a NUL byte
+- field offsets: int64 array, field `j` is `blob[offsets[j]:offsets[j + 1] - 1]`
+- row offsets: int64 array, row `i` are fields `rows[i]` to `rows[i + 1]`,
+  the first field of a row is its ID
+
+The offset arrays are 8-byte aligned and little-endian, the file is
+memory-mapped, so only the fields that are accessed are decoded. Fields must
+not contain NUL, the csv module does not accept it either.
+"""
+
+import os
+import sys
+import csv
+import mmap
+import struct
+
+from array import array
+from contextlib import contextmanager
+
+
+EXTENSION = ".dstore"
+MAGIC = b"DSTORE01"
+HEADER = struct.Struct("<8sQQQ")
+
+
+def is_store(path):
+  return path.endswith(EXTENSION)
+
+
+def read_rows(path, header=False):
+  # Rows of a descriptor CSV file or store as lists of strings, a store
+  # has no header row.
+  if is_store(path):
+    store = DescriptorStore(path)
+    try:
+      for row in store:
+        yield row
+    finally:
+      store.close()
+    return
+
+  with open(path, encoding="UTF-8") as input_stream:
+    reader = csv.reader(input_stream)
+    if header:
+      next(reader, None)
+    for row in reader:
+      yield row
+
+
+@contextmanager
+def open_writer(path):
+  # Object with writerow and writerows, as returned by csv.writer.
+  if is_store(path):
+    writer = DescriptorStoreWriter(path)
+    try:
+      yield writer
+    finally:
+      writer.close()
+    return
+
+  with open(path, "w", encoding="UTF-8", newline='') as output_stream:
+    yield csv.writer(output_stream)
+
+
+class DescriptorStore(object):
+  """
+  Read-only view of a descriptor store file.
+  Indexing by ID behaves as a dict built from the rows, the last row with
+  given ID wins, all rows of an ID are returned by find.
+  """
+
+  def __init__(self, path):
+    if sys.byteorder != "little":
+      raise ValueError("Descriptor store requires a little-endian platform.")
+    with open(path, "rb") as input_stream:
+      self.map = mmap.mmap(input_stream.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, rows, fields, blob_size = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC:
+      self.map.close()
+      raise ValueError("File [%s] is not a descriptor store." % path)
+
+    self.view = memoryview(self.map)
+    start = HEADER.size
+    self.blob = self.view[start:start + blob_size]
+    start = _aligned(start + blob_size)
+    self.field_offsets = self.view[start:start + 8 * (fields + 1)].cast("q")
+    start += 8 * (fields + 1)
+    self.row_offsets = self.view[start:start + 8 * (rows + 1)].cast("q")
+    self.index = None
+
+  def __len__(self):
+    return len(self.row_offsets) - 1
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.row(i)
+
+  def __contains__(self, key):
+    return key in self._index()
+
+  def __getitem__(self, key):
+    return self.values(self._index()[key][-1])
+
+  def field(self, j):
+    return str(self.blob[self.field_offsets[j]:self.field_offsets[j + 1] - 1], "utf-8")
+
+  def key(self, i):
+    return self.field(self.row_offsets[i])
+
+  def values(self, i):
+    return self._fields(self.row_offsets[i] + 1, self.row_offsets[i + 1])
+
+  def row(self, i):
+    return self._fields(self.row_offsets[i], self.row_offsets[i + 1])
+
+  def _fields(self, start, end):
+    # Consecutive fields are decoded at once and split on the terminators.
+    if start == end:
+      return []
+    return str(self.blob[self.field_offsets[start]:self.field_offsets[end] - 1], "utf-8").split("\0")
+
+  def find(self, key):
+    return self._index().get(key, [])
+
+  def _index(self):
+    # Only the IDs are decoded to build the index.
+    if self.index is None:
+      self.index = {}
+      for i in range(len(self)):
+        self.index.setdefault(self.key(i), []).append(i)
+    return self.index
+
+  def close(self):
+    self.row_offsets.release()
+    self.field_offsets.release()
+    self.blob.release()
+    self.view.release()
+    self.map.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class DescriptorStoreWriter(object):
+  """
+  Writes a descriptor store file row by row, as csv.writer does. The blob is
+  streamed into the file, only the offsets are kept in memory.
+  """
+
+  def __init__(self, path):
+    if sys.byteorder != "little":
+      raise ValueError("Descriptor store requires a little-endian platform.")
+    self.stream = open(path, "wb")
+    self.stream.write(HEADER.pack(MAGIC, 0, 0, 0))
+    self.field_offsets = array("q", [ 0 ])
+    self.row_offsets = array("q", [ 0 ])
+
+  def writerow(self, row):
+    offset = self.field_offsets[-1]
+    for field in row:
+      data = ("" if field is None else str(field)).encode("utf-8")
+      if b"\0" in data:
+        raise ValueError("Descriptor store field cannot contain NUL.")
+      self.stream.write(data + b"\0")
+      offset += len(data) + 1
+      self.field_offsets.append(offset)
+    self.row_offsets.append(len(self.field_offsets) - 1)
+
+  def writerows(self, rows):
+    for row in rows:
+      self.writerow(row)
+
+  def close(self):
+    blob_size = self.field_offsets[-1]
+    end = HEADER.size + blob_size
+    self.stream.write(b"\0" * (_aligned(end) - end))
+    self.field_offsets.tofile(self.stream)
+    self.row_offsets.tofile(self.stream)
+    self.stream.seek(0, os.SEEK_SET)
+    self.stream.write(HEADER.pack(MAGIC, len(self.row_offsets) - 1, len(self.field_offsets) - 1, blob_size))
+    self.stream.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def _aligned(offset):
+  return (offset + 7) // 8 * 8
@@ -2,18 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import os
-import csv
 import argparse
 import logging
 import numpy as np
 import json
 import re
 
+import multiprocessing as mp
+
 from tqdm import tqdm
-from functools import reduce
 
-from gensim.models import Word2Vec
+from gensim.models import Word2Vec, KeyedVectors
+
+from descriptor_store import read_rows, open_writer
+
 
+WORD_SEPARATOR = re.compile('[^\w]+')
+BATCH_SIZE = 10000
+
+# Data inherited by the forked workers, so it is not pickled for every shard.
+_SHARED = {}
 
 def main():
   logging.basicConfig(
@@ -37,24 +45,22 @@ def main():
     return 0
 
   logging.info("Loading vector model ...")
-  model = load_model(args["model"])
+  model = load_model(args["model"], args["keyed_vectors"])
   if model is None:
     logging.error("Error occurred during model loading.")
     return 2
 
   logging.info("Computing average vectors for descriptors...")
-  vectors = {}
-  for d in tqdm(descriptors):
-    vector = []
-    for content in descriptors[d]:
-      vs = list(map(lambda w: model.wv[w] if w in model.wv else model.wv[w.lower()], filter(lambda w: len(w) > 0 and (w in model.wv or w.lower() in model.wv), re.split('[^\w]+', content))))
-      if len(vs) > 0:
-        vector.append(reduce(lambda x, y: x+y, vs)/len(vs))
-    
-    vectors[d] = (reduce(lambda x, y: x+y, vector)/len(vector)).tolist() if len(vector) > 0 else []
+  ids, vectors, mask = average_vectors(model, descriptors, args["workers"])
 
   logging.info("Saving vector descriptors...")
-  save_descriptors(args["output"], args["rewrite"], vectors)
+  if args["output"].endswith(".npy") or args["output"].endswith(".npz"):
+    saved = save_vectors(args["output"], args["rewrite"], ids, vectors, mask)
+  else:
+    saved = save_descriptors(args["output"], args["rewrite"], ids, vectors, mask)
+  if not saved:
+    logging.error("File cannot be saved.")
+    return 3
 
   logging.info("Finished ...")
   return 0
@@ -74,6 +80,9 @@ def read_configuration():
   parser.add_argument("-m", "--model",
     type=str, dest="model", required=True,
     help="Path to Word2Vec model.")
+  parser.add_argument("--keyed-vectors",
+    action="store_true", dest="keyed_vectors", required=False, default=False,
+    help="The model is keyed vectors file, load it memory-mapped.")
 
   parser.add_argument("-o", "--out", "--output",
     type=str, dest="output", required=True,
@@ -81,33 +90,133 @@ def read_configuration():
   parser.add_argument("--rewrite",
     action="store_true", dest="rewrite", required=False, default=False,
     help="Rewrite existing output CSV file.")
+
+  parser.add_argument("--workers",
+    type=int, dest="workers", required=False, default=1,
+    help="Number of worker processes.")
   
   args = vars(parser.parse_args())
 
   return args
 
 
-def load_model(model_path):
-  return Word2Vec.load(model_path)
+def load_model(model_path, keyed_vectors = False):
+  if keyed_vectors:
+    return KeyedVectors.load(model_path, mmap="r")
+  return Word2Vec.load(model_path).wv
+
+
+def average_vectors(model, descriptors, workers = 1):
+  keys = list(descriptors.keys())
+  vectors = np.zeros((len(keys), model.vectors.shape[1]), dtype=np.float32)
+  mask = np.zeros(len(keys), dtype=bool)
+  shards = [ (start, min(start + BATCH_SIZE, len(keys))) for start in range(0, len(keys), BATCH_SIZE) ]
+
+  _SHARED["model"] = model
+  _SHARED["keys"] = keys
+  _SHARED["descriptors"] = descriptors
+  if workers > 1:
+    # Fork, so the workers share the (memory-mapped) model and descriptors.
+    with mp.get_context("fork").Pool(workers) as pool:
+      for (start, end), (shard_vectors, shard_mask) in zip(shards, tqdm(pool.imap(average_shard, shards), total=len(shards))):
+        vectors[start:end] = shard_vectors
+        mask[start:end] = shard_mask
+  else:
+    for start, end in tqdm(shards):
+      vectors[start:end], mask[start:end] = average_shard((start, end))
+  _SHARED.clear()
+  return keys, vectors, mask
+
+
+def average_shard(shard):
+  start, end = shard
+  model = _SHARED["model"]
+  if "rows" not in _SHARED:
+    _SHARED["rows"] = VocabularyRows(vocabulary_rows(model))
+  batch = [ _SHARED["descriptors"][d] for d in _SHARED["keys"][start:end] ]
+  vectors = np.zeros((end - start, model.vectors.shape[1]), dtype=np.float32)
+  mask = np.zeros(end - start, dtype=bool)
+  average_batch(model.vectors, _SHARED["rows"], batch, vectors, mask)
+  return vectors, mask
+
+
+def average_batch(matrix, rows, batch, vectors, mask):
+  # Every content is an average of its word vectors and every descriptor is
+  # an average of its non-empty contents. Words are resolved to rows of the
+  # embedding matrix first, so both averages are segment sums over a single
+  # gathered array.
+  words = []
+  word_counts = []
+  owners = []
+  for index, contents in enumerate(batch):
+    for content in contents:
+      tokens = WORD_SEPARATOR.split(content)
+      words.extend(tokens)
+      word_counts.append(len(tokens))
+      owners.append(index)
+
+  ids = np.fromiter(map(rows.__getitem__, words), dtype=np.int64, count=len(words))
+  found = ids >= 0
+  if not found.any():
+    return
+
+  lengths = np.add.reduceat(found.astype(np.int64), segment_starts(np.array(word_counts)))
+  contents = lengths > 0
+  lengths = lengths[contents]
+  means = np.add.reduceat(matrix[ids[found]], segment_starts(lengths))
+  means /= lengths.astype(matrix.dtype)[:, None]
+
+  counts = np.bincount(np.array(owners)[contents], minlength=len(batch))
+  nonempty = np.flatnonzero(counts)
+  averages = np.add.reduceat(means, segment_starts(counts[nonempty]))
+  averages /= counts[nonempty].astype(matrix.dtype)[:, None]
+
+  vectors[nonempty] = averages
+  mask[nonempty] = True
+
+
+def segment_starts(lengths):
+  starts = np.zeros(len(lengths), dtype=np.int64)
+  np.cumsum(lengths[:-1], out=starts[1:])
+  return starts
+
+
+def vocabulary_rows(model):
+  # Gensim 4 exposes key_to_index, older versions keep the index in vocab.
+  if hasattr(model, "key_to_index"):
+    return model.key_to_index
+  return { word: vocab.index for word, vocab in model.vocab.items() }
+
+
+class VocabularyRows(dict):
+  """Memo of word to embedding row, -1 for words out of vocabulary."""
+
+  def __init__(self, rows):
+    super().__init__()
+    self.rows = rows
+
+  def __missing__(self, word):
+    row = -1
+    if len(word) == 0:
+      row = -1
+    elif word in self.rows:
+      row = self.rows[word]
+    else:
+      row = self.rows.get(word.lower(), -1)
+    self[word] = row
+    return row
 
 
 def load_descriptors(descriptors_path, header):
   if not valid_file_for_read(descriptors_path):
     return None
   
-  with open(descriptors_path, encoding="UTF-8") as input_stream:
-    reader = csv.reader(input_stream)
-
-    if header:
-      logging.debug("Skipping header info ...")
-      next(reader, None)
-
-    descriptors = {}
-    for row in reader:
-      if not row[0] in descriptors:
-        descriptors[row[0]] = []
-      descriptors[row[0]].extend(row[1:])
-    return descriptors
+  descriptors = {}
+  for row in read_rows(descriptors_path, header):
+    if not row[0] in descriptors:
+      descriptors[row[0]] = []
+    descriptors[row[0]].extend(row[1:])
+  return descriptors
 
 
 def valid_file_for_read(file_path):
@@ -118,17 +227,34 @@ def valid_file_for_read(file_path):
   return True
 
 
-def save_descriptors(descriptors_path, rewrite, descriptors):
+def save_descriptors(descriptors_path, rewrite, ids, vectors, mask):
   if not valid_file_for_write(descriptors_path, rewrite):
     return False
   
-  with open(descriptors_path, "w", encoding="UTF-8", newline='') as output_stream:
-    writer = csv.writer(output_stream)
-    for d in descriptors:
-      writer.writerow( [ d ] + descriptors[d] )
+  with open_writer(descriptors_path) as writer:
+    for i, d in enumerate(ids):
+      writer.writerow( [ d ] + ( vectors[i].tolist() if mask[i] else [] ) )
     return True
 
 
+def save_vectors(vectors_path, rewrite, ids, vectors, mask):
+  # The .npy file holds only the matrix, so it can be memory-mapped, the
+  # IDs and mask are stored next to it. The .npz file holds all of them.
+  if not valid_file_for_write(vectors_path, rewrite):
+    return False
+
+  if vectors_path.endswith(".npz"):
+    np.savez(vectors_path, vectors=vectors, ids=np.array(ids), mask=mask)
+    return True
+
+  index_path = vectors_path[:-len(".npy")] + ".index.npz"
+  if not valid_file_for_write(index_path, rewrite):
+    return False
+  np.save(vectors_path, vectors)
+  np.savez(index_path, ids=np.array(ids), mask=mask)
+  return True
+
+
 def valid_file_for_write(file_path, rewrite = False):
   if not os.path.exists(file_path):
     return True
@@ -3,10 +3,15 @@
 
 import argparse
 import logging
-import csv
 import os
+import heapq
+import tempfile
+import itertools
 
-from functools import reduce
+from descriptor_store import read_rows, open_writer
+
+
+RUN_SIZE = 100000
 
 
 def main():
@@ -21,34 +26,42 @@ def main():
     logging.warning("Existing output CSV file cannot be overrided.")
     return 0
 
-  logging.info("Loading and left descriptors ... [from %s]" % args["left_input"])
-  ldescriptors = load_descriptors(args["left_input"], args["left_header"])
-
-  if ldescriptors is None:
-    logging.error("Error occured during left descriptors reading.")
+  inputs = []
+  if args["left_input"]:
+    inputs.append((args["left_input"], args["left_header"]))
+  if args["right_input"]:
+    inputs.append((args["right_input"], args["right_header"]))
+  for input_path in args["inputs"] or []:
+    inputs.append((input_path, args["input_header"]))
+  if len(inputs) == 0:
+    logging.error("No input descriptors were given.")
     return 1
-  if len(ldescriptors) == 0:
-    logging.warning("No left descriptors were loaded.")
-    return 0
-  
-  logging.info("Loading and right descriptors ... [from %s]" % args["right_input"])
-  rdescriptors = load_descriptors(args["right_input"], args["right_header"])
 
-  if rdescriptors is None:
-    logging.error("Error occured during right descriptors reading.")
-    return 1
-  if len(rdescriptors) == 0:
-    logging.warning("No right descriptors were loaded.")
+  if args["sorted"] or args["external_sort"]:
+    logging.info("Merging sorted descriptors into file %s ..." % args["output"])
+    if not merge_descriptors(inputs, args["output"], args["rewrite"], args["external_sort"]):
+      logging.error("Error occured during descriptors merging.")
+      return 1
+    logging.info("Finished ...")
     return 0
 
-  logging.info("Merging...")
   descriptors = {}
-  for key in ldescriptors:
-    descriptors[key] = [reduce(lambda x, y: x + " " + y, ldescriptors[key]) if len(ldescriptors) > 0 else ""]
-  for key in rdescriptors:
-    if key not in descriptors:
-      descriptors[key] = []
-    descriptors[key].append(reduce(lambda x, y: x + " " + y, rdescriptors[key]) if len(rdescriptors) > 0 else "")
+  for input_path, header in inputs:
+    logging.info("Loading descriptors ... [from %s]" % input_path)
+    idescriptors = load_descriptors(input_path, header)
+
+    if idescriptors is None:
+      logging.error("Error occured during descriptors reading [%s]." % input_path)
+      return 1
+    if len(idescriptors) == 0:
+      logging.warning("No descriptors were loaded [%s]." % input_path)
+      return 0
+
+    logging.info("Merging...")
+    for key in idescriptors:
+      if key not in descriptors:
+        descriptors[key] = []
+      descriptors[key].append(" ".join(idescriptors[key]))
 
   logging.info("Writing descriptors into file %s ..." % args["output"])
   if not save_descriptors(args["output"], args["rewrite"], descriptors):
@@ -64,19 +77,33 @@ def read_configuration():
     description="Calculate threshold from a CSV dense distance matrix file.")
   
   parser.add_argument("-l", "--left", "--left-input",
-    type=str, dest="left_input", required=True,
+    type=str, dest="left_input", required=False,
     help="Path to left CSV file containing descriptors.")
   parser.add_argument("--left-header",
     action="store_true", dest="left_header", required=False, default=False,
     help="Determines if the left CSV file has header.")
   
   parser.add_argument("-r", "--right", "--right-input",
-    type=str, dest="right_input", required=True,
+    type=str, dest="right_input", required=False,
     help="Path to right CSV file containing descriptors.")
   parser.add_argument("--right-header",
     action="store_true", dest="right_header", required=False, default=False,
     help="Determines if the right CSV file has header.")
 
+  parser.add_argument("-i", "--in", "--input",
+    type=str, dest="inputs", required=False, action="append",
+    help="Path to another CSV file containing descriptors, can be repeated.")
+  parser.add_argument("--input-header",
+    action="store_true", dest="input_header", required=False, default=False,
+    help="Determines if the other CSV files have header.")
+
+  parser.add_argument("--sorted",
+    action="store_true", dest="sorted", required=False, default=False,
+    help="Input CSV files are sorted by ID, merge them in a single pass.")
+  parser.add_argument("--external-sort",
+    action="store_true", dest="external_sort", required=False, default=False,
+    help="Sort input CSV files on disk first, then merge them in a single pass.")
+
   parser.add_argument("-o", "--out", "--output",
     type=str, dest="output", required=True,
     help="Path to output CSV file.")
@@ -93,19 +120,78 @@ def load_descriptors(descriptors_path, header):
   if not valid_file_for_read(descriptors_path):
     return None
   
-  with open(descriptors_path, encoding="UTF-8") as input_stream:
-    reader = csv.reader(input_stream)
+  descriptors = {}
+  for row in read_rows(descriptors_path, header):
+    if not row[0] in descriptors:
+      descriptors[row[0]] = []
+    descriptors[row[0]].extend(row[1:])
+  return descriptors
+
+
+def merge_descriptors(inputs, output_path, rewrite, external_sort=False):
+  for input_path, _ in inputs:
+    if not valid_file_for_read(input_path):
+      return False
+  if not valid_file_for_write(output_path, rewrite):
+    return False
+
+  with tempfile.TemporaryDirectory() as runs_directory, open_writer(output_path) as writer:
+    streams = []
+    for index, (input_path, header) in enumerate(inputs):
+      rows = read_rows(input_path, header)
+      if external_sort:
+        rows = sort_rows(rows, runs_directory, "%s-" % index)
+      streams.append(index_groups(check_sorted(group_rows(rows), input_path), index))
+
+    # Equal keys come in the input order, so the columns are in the same
+    # order as in the in-memory join.
+    try:
+      for key, group in itertools.groupby(heapq.merge(*streams), key=lambda item: item[0]):
+        writer.writerow( [ key ] + [ " ".join(values) for _, _, values in group ] )
+    except ValueError as error:
+      logging.error(error)
+      return False
+  return True
+
+
+def group_rows(rows):
+  # Consecutive rows with the same ID are merged into one descriptor.
+  for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+    values = []
+    for row in group:
+      values.extend(row[1:])
+    yield key, values
+
+
+def check_sorted(groups, input_path):
+  previous = None
+  for key, values in groups:
+    if previous is not None and key <= previous:
+      raise ValueError("Input CSV file [%s] is not sorted by ID, found '%s' after '%s'." % (input_path, key, previous))
+    previous = key
+    yield key, values
+
+
+def index_groups(groups, index):
+  for key, values in groups:
+    yield key, index, values
 
-    if header:
-      logging.debug("Skipping header info ...")
-      next(reader, None)
 
-    descriptors = {}
-    for row in reader:
-      if not row[0] in descriptors:
-        descriptors[row[0]] = []
-      descriptors[row[0]].extend(row[1:])
-    return descriptors
+def sort_rows(rows, runs_directory, prefix):
+  # External merge sort, sorted runs of at most RUN_SIZE rows are written
+  # into temporary files and merged. Both steps are stable, so rows with the
+  # same ID keep their order.
+  runs = []
+  while True:
+    run = list(itertools.islice(rows, RUN_SIZE))
+    if len(run) == 0:
+      break
+    run.sort(key=lambda row: row[0])
+    run_path = os.path.join(runs_directory, "%s%s.dstore" % (prefix, len(runs)))
+    with open_writer(run_path) as run_writer:
+      run_writer.writerows(run)
+    runs.append(run_path)
+  return heapq.merge(*[ read_rows(run_path) for run_path in runs ], key=lambda row: row[0])
 
 
 def valid_file_for_read(file_path):
@@ -120,8 +206,7 @@ def save_descriptors(descriptors_path, rewrite, descriptors):
   if not valid_file_for_write(descriptors_path, rewrite):
     return False
   
-  with open(descriptors_path, "w", encoding="UTF-8", newline='') as output_stream:
-    writer = csv.writer(output_stream)
+  with open_writer(descriptors_path) as writer:
     for d in descriptors:
       writer.writerow( [ d ] + descriptors[d] )
     return True
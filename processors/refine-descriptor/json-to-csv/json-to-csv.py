@@ -2,21 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
 import json
 import os
 import logging
 import csv
 import typing
 
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_SUFFIX = ".index.json"
+
 
 def _parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True,
-                        help="Path to DCAT-AP compatible TRIG.")
+                        help="Path to descriptor directory or .jsonl pack.")
     parser.add_argument("--output", required=True,
-                        help="Path to output directory.")
-    parser.add_argument("--property", required=True,
-                        help="Name of a property to extract.")
+                        help="Path to output CSV file, or directory "
+                             "for more properties.")
+    parser.add_argument("--property", required=True, action="append",
+                        help="Name of a property to extract, can be repeated.")
     parser.add_argument("--linePerValue", action="store_true",
                         help="If set there is only one value on each line.")
     return vars(parser.parse_args())
@@ -24,7 +29,10 @@ def _parse_arguments():
 
 def main(arguments):
     _init_logging()
-    _create_parent_directory(arguments["output"])
+    if len(arguments["property"]) > 1:
+        os.makedirs(arguments["output"], exist_ok=True)
+    else:
+        _create_parent_directory(arguments["output"])
     export_property(arguments)
 
 
@@ -65,18 +73,37 @@ def _write_mode_default(writer, iri, values):
 def _convert_to_csv(arguments, write_values_fnc):
     logging.info("Transforming files ...")
     index = 0
-    with open(arguments["output"], "w", newline="") as output_stream:
-        writer = csv.writer(output_stream, delimiter=",", quoting=csv.QUOTE_ALL)
-        writer.writerow(["iri", arguments["property"]])
+    # All properties are exported in one pass over the input files.
+    with contextlib.ExitStack() as stack:
+        writers = []
+        for property_name, output_file in _output_files(arguments):
+            output_stream = stack.enter_context(
+                open(output_file, "w", newline=""))
+            writer = csv.writer(
+                output_stream, delimiter=",", quoting=csv.QUOTE_ALL)
+            writer.writerow(["iri", property_name])
+            writers.append((property_name, writer))
         for index, _, content in _iterate_input_files(arguments["input"]):
-            values, _ = _select_property(arguments["property"], content)
-            write_values_fnc(writer, content["iri"], values)
+            for property_name, writer in writers:
+                values, _ = _select_property(property_name, content)
+                write_values_fnc(writer, content["iri"], values)
             if index % 1000 == 0:
                 logging.info("    %s", index)
     logging.info("    %s", index)
     logging.info("Transforming files ... done")
 
 
+def _output_files(arguments) -> typing.List[typing.Tuple[str, str]]:
+    properties = arguments["property"]
+    if len(properties) == 1:
+        return [(properties[0], arguments["output"])]
+    return [
+        (property_name, os.path.join(
+            arguments["output"], property_name + ".csv"))
+        for property_name in properties
+    ]
+
+
 def _values_to_list(values) -> typing.List[str]:
     values_as_list = values if isinstance(values, list) else [values]
     result = []
@@ -95,21 +122,6 @@ def _values_to_list(values) -> typing.List[str]:
     return result
 
 
-def _export_mode_default(arguments):
-    logging.info("Transforming files ...")
-    index = 0
-    with open(arguments["output"], "w", newline="") as output_stream:
-        writer = csv.writer(output_stream, delimiter=",", quoting=csv.QUOTE_ALL)
-        writer.writerow(["iri", arguments["property"]])
-        for index, _, content in _iterate_input_files(arguments["input"]):
-            values, _ = _select_property(arguments["property"], content)
-            writer.writerow([content["iri"], *_values_to_list(values)])
-            if index % 1000 == 0:
-                logging.info("    %s", index)
-    logging.info("    %s", index)
-    logging.info("Transforming files ... done")
-
-
 # region Transformation
 
 def _select_property(
@@ -134,25 +146,70 @@ def _transform_files(
         input_directory: str, output_directory: str, transformer) -> None:
     logging.info("Transforming files ...")
     index = 0
-    for index, file_name, content in _iterate_input_files(input_directory):
-        result = transformer(content)
-        output_file = os.path.join(output_directory, file_name)
-        with open(output_file, "w", encoding="utf-8") as stream:
-            json.dump(result, stream)
-        if index % 1000 == 0:
-            logging.info("    %s", index)
+    with _open_output_files(output_directory) as write_file:
+        for index, file_name, content in \
+                _iterate_input_files(input_directory):
+            write_file(file_name, transformer(content))
+            if index % 1000 == 0:
+                logging.info("    %s", index)
     logging.info("    %s", index)
     logging.info("Transforming files ... done")
 
 
+@contextlib.contextmanager
+def _open_output_files(output_path: str):
+    if not _is_packed(output_path):
+        def write_file(file_name: str, content) -> None:
+            output_file = os.path.join(output_path, file_name)
+            with open(output_file, "w", encoding="utf-8") as stream:
+                json.dump(content, stream)
+
+        yield write_file
+        return
+    # Packed files are JSON lines "[file_name, content]", the offset index
+    # of the lines is stored next to them.
+    offsets = {}
+    position = 0
+    with open(output_path, "wb") as stream:
+        def write_file(file_name: str, content) -> None:
+            nonlocal position
+            line = (json.dumps([file_name, content]) + "\n").encode("utf-8")
+            stream.write(line)
+            offsets[file_name] = position
+            position += len(line)
+
+        yield write_file
+    with open(output_path + PACKED_INDEX_SUFFIX, "w", encoding="utf-8") \
+            as stream:
+        json.dump(offsets, stream)
+
+
 def _iterate_input_files(input_directory: str):
-    for index, file_name in enumerate(os.listdir(input_directory)):
+    if _is_packed(input_directory):
+        with open(input_directory, "r", encoding="utf-8") as stream:
+            for index, line in enumerate(stream):
+                file_name, input_content = json.loads(line)
+                yield index, file_name, input_content
+        return
+    for index, file_name in enumerate(_list_input_files(input_directory)):
         input_file = os.path.join(input_directory, file_name)
         with open(input_file, "r", encoding="utf-8") as stream:
             input_content = json.load(stream)
         yield index, file_name, input_content
 
 
+def _list_input_files(input_directory: str) -> typing.List[str]:
+    # Hidden files, like the manifest of an incremental run, are skipped.
+    return [
+        file_name for file_name in os.listdir(input_directory)
+        if not file_name.startswith(".")
+    ]
+
+
+def _is_packed(path: str) -> bool:
+    return path.endswith(PACKED_EXTENSION)
+
+
 # endregion
 
 
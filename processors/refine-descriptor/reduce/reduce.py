@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import os
-import csv
+import json
 import argparse
 import logging
+import tempfile
+
+from descriptor_store import DescriptorStore, is_store, read_rows, open_writer
 
 
 def main():
@@ -15,6 +18,9 @@ def main():
   
   args = read_configuration()
 
+  if args["stream"]:
+    return stream_sampled(args)
+
   rows = load_rows(args["input"], args["input_header"])
   if rows is None:
     logging.error("Error occured during descriptors reading.")
@@ -57,6 +63,10 @@ def read_configuration():
   parser.add_argument("--rewrite",
     action="store_true", dest="rewrite", required=False, default=False,
     help="Rewrite existing output CSV file.")
+
+  parser.add_argument("--stream",
+    action="store_true", dest="stream", required=False, default=False,
+    help="Scan the descriptors once and keep only the sampled rows, spilled to disk.")
   
   args = vars(parser.parse_args())
 
@@ -67,38 +77,116 @@ def load_rows(input_path, input_header):
   if not valid_file_for_read(input_path):
     return None
   
-  with open(input_path, encoding="utf-8") as input_stream:
-    reader = csv.reader(input_stream)
-    if input_header:
-      next(reader, None)
-    
-    descriptors = {}
-    for row in reader:
-      descriptors[row[0]] = row[1:]
-    return descriptors
+  descriptors = {}
+  for row in read_rows(input_path, input_header):
+    descriptors[row[0]] = row[1:]
+  return descriptors
+
+
+def stream_sampled(args):
+  idxs = load_idxs(args["sample"], args["sample_header"])
+  if idxs is None:
+    logging.error("Error occured during sample reading.")
+    return 2
+
+  if is_store(args["input"]):
+    # The store is read in place, nothing has to be spilled.
+    if not valid_file_for_read(args["input"]):
+      logging.error("Error occured during descriptors reading.")
+      return 1
+    with DescriptorStore(args["input"]) as store:
+      rows = StoreRows(store, set(idxs))
+      if not save_sampled(rows, idxs, args["output"], args["rewrite"]):
+        logging.error("Error occured during saving.")
+        return 3
+    logging.info("Sample created...")
+    return 0
+
+  with tempfile.TemporaryFile() as spill_stream:
+    rows = spill_rows(args["input"], args["input_header"], set(idxs), spill_stream)
+    if rows is None:
+      logging.error("Error occured during descriptors reading.")
+      return 1
+
+    if not save_sampled(rows, idxs, args["output"], args["rewrite"]):
+      logging.error("Error occured during saving.")
+      return 3
+  
+  logging.info("Sample created...")
+  return 0
+
+
+def spill_rows(input_path, input_header, keys, spill_stream):
+  if not valid_file_for_read(input_path):
+    return None
+  
+  rows = SpilledRows(spill_stream)
+  for row in read_rows(input_path, input_header):
+    if row[0] in keys:
+      rows.append(row[0], row[1:])
+  return rows
+
+
+class SpilledRows(object):
+  """
+  Rows stored in a temporary file, only their offsets are kept in memory.
+  The last row with given key wins, as in load_rows.
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.offsets = {}
+
+  def append(self, key, row):
+    self.stream.seek(0, os.SEEK_END)
+    self.offsets[key] = self.stream.tell()
+    self.stream.write(json.dumps(row).encode("utf-8") + b"\n")
+
+  def __contains__(self, key):
+    return key in self.offsets
+
+  def __getitem__(self, key):
+    self.stream.seek(self.offsets[key])
+    return json.loads(self.stream.readline().decode("utf-8"))
+
+
+class StoreRows(object):
+  """
+  Rows of a descriptor store with given keys, the IDs are scanned once and
+  only numbers of the matching rows are kept in memory.
+  The last row with given key wins, as in load_rows.
+  """
+
+  def __init__(self, store, keys):
+    self.store = store
+    self.rows = {}
+    for i in range(len(store)):
+      key = store.key(i)
+      if key in keys:
+        self.rows[key] = i
+
+  def __contains__(self, key):
+    return key in self.rows
+
+  def __getitem__(self, key):
+    return self.store.values(self.rows[key])
 
 
 def load_idxs(sample_path, sample_header):
   if not valid_file_for_read(sample_path):
     return None
   
-  with open(sample_path, encoding="utf-8") as input_stream:
-    reader = csv.reader(input_stream)
-    if sample_header:
-      next(reader, None)
-    
-    samples = []
-    for row in reader:
-      samples.append(row[0])
-    return samples
+  samples = []
+  for row in read_rows(sample_path, sample_header):
+    samples.append(row[0])
+  return samples
 
 
 def save_sampled(rows, idxs, output_path, output_rewrite):
   if not valid_file_for_write(output_path, output_rewrite):
     return False
   
-  with open(output_path, "w", newline='\n', encoding="utf-8") as output_stream:
-    writer = csv.writer(output_stream)
+  with open_writer(output_path) as writer:
     for idx in enumerate(idxs):
       writer.writerow( [idx[0]] + ( rows[idx[1]] if idx[1] in rows else [] ) )
     return True
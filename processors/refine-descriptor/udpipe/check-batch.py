@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+
+from ufal.udpipe import Model
+
+from udpipe import load_descriptors, udpipe_values
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] - %(message)s",
+    datefmt="%H:%M:%S")
+
+  args = read_configuration()
+
+  descriptors = load_descriptors(args["input"], args["header"])
+  if descriptors is None:
+    logging.error("Error occured during descriptors reading.")
+    return 1
+
+  model = Model.load(args["model"])
+  if not model:
+    logging.error("Cannot load model from file '%s'." % args["model"])
+    return 2
+
+  values = list(dict.fromkeys(s for d in descriptors for s in descriptors[d]))
+  logging.info("Lemmatizing %s values with batch 1 and %s ..." % (len(values), args["batch"]))
+  expected = udpipe_values(model, values, args["filter"], 1)
+  actual = udpipe_values(model, values, args["filter"], args["batch"])
+
+  different = [ (s, e, a) for s, e, a in zip(values, expected, actual) if e != a ]
+  for s, e, a in different[:10]:
+    logging.error("Value [%s] is [%s] with batch 1, [%s] with batch %s." % (s, e, a, args["batch"]))
+  logging.info("Different values: %s of %s" % (len(different), len(values)))
+  return 3 if len(different) > 0 else 0
+
+
+def read_configuration():
+  parser = argparse.ArgumentParser(
+    description="Check that batching does not change the lemmas of udpipe.py.")
+
+  parser.add_argument("-i", "--in", "--input",
+    type=str, dest="input", required=True,
+    help="Path to input CSV file containing descriptors.")
+  parser.add_argument("--header",
+    action="store_true", dest="header", required=False, default=False,
+    help="Determines if the input CSV file has header.")
+
+  parser.add_argument("-m", "--model",
+    type=str, dest="model", required=True,
+    help="Path to UDPIPE model")
+  parser.add_argument("-f", "--filter",
+    action="store_true", dest="filter", required=False, default=False,
+    help="Filter only nouns, verbs, adjectives and adverbs.")
+
+  parser.add_argument("--batch",
+    type=int, dest="batch", required=False, default=50,
+    help="Batch size compared with batch 1.")
+
+  args = vars(parser.parse_args())
+
+  return args
+
+
+if __name__ == "__main__":
+  exit(main())
@@ -3,14 +3,26 @@
 
 import argparse
 import logging
-import csv
 import os
+import time
+import hashlib
+import sqlite3
 
+import multiprocessing as mp
 from functools import reduce
 
 from tqdm import tqdm
 from ufal.udpipe import Model, Sentence, ProcessingError
 
+from descriptor_store import read_rows, open_writer
+
+
+CHUNK_SIZE = 1000
+STREAM_BATCH_SIZE = 10000
+
+# Model loaded by the pool initializer in every worker process.
+_WORKER = {}
+
 
 def main():
   logging.basicConfig(
@@ -24,26 +36,67 @@ def main():
     logging.warning("Existing output CSV file cannot be overrided.")
     return 0
 
-  logging.info("Loading and merging descriptors ... [from %s]" % args["input"])
-  descriptors = load_descriptors(args["input"], args["header"])
-
-  if descriptors is None:
-    logging.error("Error occured during descriptors reading.")
-    return 1
-  if len(descriptors) == 0:
-    logging.warning("No descriptors were loaded.")
-    return 0
-
-  logging.info("Loading model %s" % args["model"])
-  model = Model.load(args["model"])
-  if not model:
-    logging.error("Cannot load model from file '%s'." % args["model"])
-    return 2
-  logging.info("Model loaded...")
-
-  if not udpipe_descriptors(model, descriptors, args["filter"]):
-    logging.error("Error occurred during UDPipe.")
-    return 3
+  descriptors = None
+  if args["stream"]:
+    if not valid_file_for_read(args["input"]):
+      logging.error("Error occured during descriptors reading.")
+      return 1
+  else:
+    logging.info("Loading and merging descriptors ... [from %s]" % args["input"])
+    descriptors = load_descriptors(args["input"], args["header"])
+
+    if descriptors is None:
+      logging.error("Error occured during descriptors reading.")
+      return 1
+    if len(descriptors) == 0:
+      logging.warning("No descriptors were loaded.")
+      return 0
+
+  # With workers every worker loads its own model, the parent does not
+  # lemmatize anything, so it does not keep another copy.
+  model = None
+  if args["workers"] > 1:
+    if not valid_file_for_read(args["model"]):
+      logging.error("Cannot load model from file '%s'." % args["model"])
+      return 2
+  else:
+    logging.info("Loading model %s" % args["model"])
+    model = Model.load(args["model"])
+    if not model:
+      logging.error("Cannot load model from file '%s'." % args["model"])
+      return 2
+    logging.info("Model loaded...")
+
+  cache = None
+  if args["cache"]:
+    logging.info("Opening lemma cache %s" % args["cache"])
+    cache = LemmaCache(args["cache"], args["model"], args["cache_size"])
+
+  pool = None
+  if args["workers"] > 1:
+    logging.info("Starting %s workers ..." % args["workers"])
+    pool = mp.Pool(args["workers"], initializer=init_worker, initargs=(args["model"],))
+
+  try:
+    if args["stream"]:
+      logging.info("Streaming descriptors ... [from %s into %s]" % (args["input"], args["output"]))
+      if not stream_descriptors(args["input"], args["header"], args["output"], model, args["filter"], pool, cache, args["batch"]):
+        logging.error("Error occurred during UDPipe.")
+        return 3
+      logging.info("Finished ...")
+      return 0
+
+    if not udpipe_descriptors(model, descriptors, args["filter"], pool, cache, args["batch"]):
+      logging.error("Error occurred during UDPipe.")
+      return 3
+  finally:
+    if pool is not None:
+      pool.close()
+    if cache is not None:
+      cache.evict()
+      if args["cache_stats"]:
+        cache.log_statistics()
+      cache.close()
 
   logging.info("Writing descriptors into file %s ..." % args["output"])
   if not save_descriptors(args["output"], args["rewrite"], descriptors):
@@ -54,38 +107,220 @@ def main():
   return 0
 
 
-def udpipe_descriptors(model, descriptors, filter_words=False):
+def udpipe_descriptors(model, descriptors, filter_words=False, pool=None, cache=None, batch_size=1):
+  # Identical values are lemmatized only once, the memo is keyed by the value
+  # and the filter mode.
+  memo = {}
+  values = []
+  total = 0
+  for d in descriptors:
+    for s in descriptors[d]:
+      total += 1
+      if (s, filter_words) not in memo:
+        memo[(s, filter_words)] = None
+        values.append(s)
+  logging.info("Found %s unique values of %s (memo hit rate %.1f%%)" % (len(values), total, memo_hit_rate(len(values), total)))
+
+  if cache is not None:
+    cached = cache.get(values, filter_words)
+    for s in cached:
+      memo[(s, filter_words)] = cached[s]
+    values = [ s for s in values if s not in cached ]
+    logging.info("Found %s values in the cache" % len(cached))
+
+  logging.info("Lemmatizing %s values ..." % len(values))
+
+  if pool is None:
+    lemmas = udpipe_values(model, tqdm(values), filter_words, batch_size)
+  else:
+    chunks = [ (values[i:i + CHUNK_SIZE], filter_words, batch_size) for i in range(0, len(values), CHUNK_SIZE) ]
+    lemmas = []
+    for chunk_lemmas in tqdm(pool.imap(udpipe_chunk, chunks), total=len(chunks)):
+      lemmas.extend(chunk_lemmas)
+
+  for s, lemma in zip(values, lemmas):
+    memo[(s, filter_words)] = lemma
+  if cache is not None:
+    cache.put(values, lemmas, filter_words)
+  for d in descriptors:
+    descriptors[d] = [ memo[(s, filter_words)] for s in descriptors[d] ]
+
+  return True
+
+
+def stream_descriptors(input_path, header, output_path, model, filter_words=False, pool=None, cache=None, batch_size=1):
+  # Only one batch of descriptors is kept in memory, the batch is written
+  # before the next one is read.
+  with open_writer(output_path) as writer:
+    batch = {}
+    for d, values in iterate_descriptors(input_path, header):
+      if d not in batch:
+        batch[d] = []
+      batch[d].extend(values)
+      if len(batch) < STREAM_BATCH_SIZE:
+        continue
+      if not udpipe_descriptors(model, batch, filter_words, pool, cache, batch_size):
+        return False
+      write_descriptors(writer, batch)
+      batch = {}
+    if not udpipe_descriptors(model, batch, filter_words, pool, cache, batch_size):
+      return False
+    write_descriptors(writer, batch)
+  return True
+
+
+def memo_hit_rate(unique, total):
+  if total == 0:
+    return 0.0
+  return 100.0 * (total - unique) / total
+
+
+def udpipe_values(model, values, filter_words=False, batch_size=1):
   tokenizer = model.newTokenizer(model.DEFAULT)
   if not tokenizer:
     raise Exception("The model does not have a tokenizer")
   error = ProcessingError()
 
-  for d in tqdm(descriptors):
-    lemmas = []
-    for s in descriptors[d]:
-      tokenizer.setText(s)
-
-      sentences = []
-      sentence = Sentence()
-      while tokenizer.nextSentence(sentence, error):
-        model.tag(sentence, model.DEFAULT)
-        sentences.append(sentence)
-        sentence = Sentence()
-      
-      if error.occurred():
-        raise Exception(error.message)
-
-      words = reduce(lambda x, y: x+y, [[( w.lemma, w.upostag ) for w in s.words] for s in sentences], [])
-      if not filter_words:
-        words = list(map(lambda w: w[0], filter(lambda w: w[1] not in ['<root>'], words)))
-      else:
-        words = list(map(lambda w: w[0], filter(lambda w: w[1] in ['NOUN', 'ADJ', 'VERB', 'ADV', 'PROPN', 'X'], words)))
-      lemmas.append(reduce(lambda x, y: x + " " + y, words) if len(words) > 0 else "")  
-      
-
-    descriptors[d] = lemmas
-
-  return not error.occurred()
+  lemmas = []
+  batch = []
+  for s in values:
+    # Every value is tokenized on its own, the sentences of a value do not
+    # depend on the values before it.
+    batch.append(tokenize_text(tokenizer, error, s))
+    if len(batch) >= batch_size:
+      lemmas.extend(tag_batch(model, batch, filter_words))
+      batch = []
+  lemmas.extend(tag_batch(model, batch, filter_words))
+
+  return lemmas
+
+
+def tag_batch(model, batch, filter_words=False):
+  # Sentences of all values in the batch are tagged in one pass.
+  for sentences in batch:
+    for sentence in sentences:
+      model.tag(sentence, model.DEFAULT)
+  return [ sentences_to_lemmas(sentences, filter_words) for sentences in batch ]
+
+
+def tokenize_text(tokenizer, error, text):
+  tokenizer.setText(text)
+
+  sentences = []
+  sentence = Sentence()
+  while tokenizer.nextSentence(sentence, error):
+    sentences.append(sentence)
+    sentence = Sentence()
+  
+  if error.occurred():
+    raise Exception(error.message)
+
+  return sentences
+
+
+def sentences_to_lemmas(sentences, filter_words=False):
+  words = reduce(lambda x, y: x+y, [[( w.lemma, w.upostag ) for w in s.words] for s in sentences], [])
+  if not filter_words:
+    words = list(map(lambda w: w[0], filter(lambda w: w[1] not in ['<root>'], words)))
+  else:
+    words = list(map(lambda w: w[0], filter(lambda w: w[1] in ['NOUN', 'ADJ', 'VERB', 'ADV', 'PROPN', 'X'], words)))
+  return reduce(lambda x, y: x + " " + y, words) if len(words) > 0 else ""
+
+
+class LemmaCache(object):
+  """
+  Persistent SQLite cache of lemmatized values. Entries are keyed by hash of
+  the model file, filter mode and hash of the value. When the cache grows over
+  max_size entries, the least recently used entries are evicted.
+  """
+
+  BATCH_SIZE = 500
+
+  def __init__(self, path, model_path, max_size=0):
+    self.connection = sqlite3.connect(path)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS lemmas (model TEXT, filter INTEGER, value TEXT, lemmas TEXT, used REAL, PRIMARY KEY (model, filter, value)) WITHOUT ROWID")
+    self.connection.execute("CREATE INDEX IF NOT EXISTS lemmas_used ON lemmas (used)")
+    self.connection.commit()
+    self.path = path
+    self.model = file_hash(model_path)
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evicted = 0
+
+  def get(self, values, filter_words):
+    result = {}
+    now = time.time()
+    for i in range(0, len(values), self.BATCH_SIZE):
+      batch = { text_hash(s): s for s in values[i:i + self.BATCH_SIZE] }
+      rows = self.connection.execute(
+        "SELECT value, lemmas FROM lemmas WHERE model = ? AND filter = ? AND value IN (%s)" % ",".join("?" * len(batch)),
+        [ self.model, int(filter_words) ] + list(batch.keys())).fetchall()
+      for value, lemmas in rows:
+        result[batch[value]] = lemmas
+      self.connection.executemany(
+        "UPDATE lemmas SET used = ? WHERE model = ? AND filter = ? AND value = ?",
+        [ (now, self.model, int(filter_words), value) for value, _ in rows ])
+    self.connection.commit()
+    self.hits += len(result)
+    self.misses += len(values) - len(result)
+    return result
+
+  def put(self, values, lemmas, filter_words):
+    now = time.time()
+    self.connection.executemany(
+      "INSERT OR REPLACE INTO lemmas VALUES (?, ?, ?, ?, ?)",
+      [ (self.model, int(filter_words), text_hash(s), lemma, now) for s, lemma in zip(values, lemmas) ])
+    self.connection.commit()
+
+  def size(self):
+    return self.connection.execute("SELECT COUNT(*) FROM lemmas").fetchone()[0]
+
+  def evict(self):
+    if self.max_size <= 0:
+      return
+    over = self.size() - self.max_size
+    if over <= 0:
+      return
+    self.connection.execute(
+      "DELETE FROM lemmas WHERE (model, filter, value) IN (SELECT model, filter, value FROM lemmas ORDER BY used LIMIT ?)",
+      (over,))
+    self.connection.commit()
+    self.evicted += over
+
+  def log_statistics(self):
+    lookups = self.hits + self.misses
+    logging.info("Cache file: %s (%s bytes)" % (self.path, os.path.getsize(self.path)))
+    logging.info("Cache entries: %s (limit %s)" % (self.size(), self.max_size if self.max_size > 0 else "none"))
+    logging.info("Cache hits: %s, misses: %s (hit rate %.1f%%)" % (self.hits, self.misses, 100.0 * self.hits / lookups if lookups > 0 else 0.0))
+    logging.info("Cache evicted entries: %s" % self.evicted)
+
+  def close(self):
+    self.connection.close()
+
+
+def file_hash(file_path):
+  digest = hashlib.sha256()
+  with open(file_path, "rb") as input_stream:
+    for block in iter(lambda: input_stream.read(1 << 20), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def text_hash(text):
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def init_worker(model_path):
+  _WORKER["model"] = Model.load(model_path)
+  if not _WORKER["model"]:
+    raise Exception("Cannot load model from file '%s'." % model_path)
+
+
+def udpipe_chunk(task):
+  values, filter_words, batch_size = task
+  return udpipe_values(_WORKER["model"], values, filter_words, batch_size)
+
 
 def read_configuration():
   parser = argparse.ArgumentParser(
@@ -111,6 +346,28 @@ def read_configuration():
   parser.add_argument("-f", "--filter",
     action="store_true", dest="filter", required=False, default=False,
     help="Filter only nouns, verbs, adjectives and adverbs.")
+
+  parser.add_argument("--workers",
+    type=int, dest="workers", required=False, default=1,
+    help="Number of worker processes, each loads its own model.")
+
+  parser.add_argument("--cache",
+    type=str, dest="cache", required=False, default=None,
+    help="Path to SQLite file with lemmas cached across runs.")
+  parser.add_argument("--cache-size",
+    type=int, dest="cache_size", required=False, default=0,
+    help="Maximum number of cached values, least recently used are evicted. 0 for no limit.")
+  parser.add_argument("--cache-stats",
+    action="store_true", dest="cache_stats", required=False, default=False,
+    help="Report cache statistics at the end of the run.")
+
+  parser.add_argument("--batch",
+    type=int, dest="batch", required=False, default=1,
+    help="Number of values tagged in one pass, every value is tokenized on its own.")
+
+  parser.add_argument("--stream",
+    action="store_true", dest="stream", required=False, default=False,
+    help="Read, lemmatize and write descriptors in batches, rows of an ID must be grouped.")
   
   args = vars(parser.parse_args())
 
@@ -121,19 +378,25 @@ def load_descriptors(descriptors_path, header):
   if not valid_file_for_read(descriptors_path):
     return None
   
-  with open(descriptors_path, encoding="UTF-8") as input_stream:
-    reader = csv.reader(input_stream)
-
-    if header:
-      logging.debug("Skipping header info ...")
-      next(reader, None)
-
-    descriptors = {}
-    for row in reader:
-      if not row[0] in descriptors:
-        descriptors[row[0]] = []
-      descriptors[row[0]].extend(row[1:])
-    return descriptors
+  descriptors = {}
+  for row in read_rows(descriptors_path, header):
+    if not row[0] in descriptors:
+      descriptors[row[0]] = []
+    descriptors[row[0]].extend(row[1:])
+  return descriptors
+
+
+def iterate_descriptors(descriptors_path, header):
+  # Consecutive rows with the same ID are merged into one descriptor.
+  key, values = None, []
+  for row in read_rows(descriptors_path, header):
+    if row[0] != key:
+      if key is not None:
+        yield key, values
+      key, values = row[0], []
+    values.extend(row[1:])
+  if key is not None:
+    yield key, values
 
 
 def valid_file_for_read(file_path):
@@ -148,13 +411,16 @@ def save_descriptors(descriptors_path, rewrite, descriptors):
   if not valid_file_for_write(descriptors_path, rewrite):
     return False
   
-  with open(descriptors_path, "w", encoding="UTF-8", newline='') as output_stream:
-    writer = csv.writer(output_stream)
-    for d in descriptors:
-      writer.writerow( [ d ] + descriptors[d] )
+  with open_writer(descriptors_path) as writer:
+    write_descriptors(writer, descriptors)
     return True
 
 
+def write_descriptors(writer, descriptors):
+  for d in descriptors:
+    writer.writerow( [ d ] + descriptors[d] )
+
+
 def valid_file_for_write(file_path, rewrite = False):
   if not os.path.exists(file_path):
     return True
@@ -1,21 +1,40 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import json
 import os
 import logging
 import typing
 import argparse
+import contextlib
+import hashlib
+import multiprocessing
 import itertools
 import collections
 
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_SUFFIX = ".index.json"
+
+MANIFEST_FILE = ".manifest.json"
+
+# Size of a part of knowledge file parsed by a worker in one task.
+SCAN_RANGE_SIZE = 16 * 1024 * 1024
+
+# Number of input files transformed by a worker in one task.
+CHUNK_SIZE = 100
+
+# Transformer and paths inherited by the forked workers, the transformer
+# is a closure over the loaded data, so it is never pickled.
+_WORKER = {}
+
 
 def _parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True,
-                        help="Path to input descriptor directory.")
+                        help="Path to input directory or .jsonl pack.")
     parser.add_argument("--output", required=True,
-                        help="Path to output descriptor directory.")
+                        help="Path to output directory or .jsonl pack.")
     parser.add_argument("--knowledge", required=True,
                         help="Path to JSONL files with hierarchy.")
     parser.add_argument("--sourceProperty", required=True,
@@ -24,7 +43,17 @@ def _parse_arguments():
                         help="Name of a property to store result into.")
     parser.add_argument("--sharedThreshold", type=float, default=0.6,
                         help="How many of entity tokens must be shared.")
-    return vars(parser.parse_args())
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument("--ordered", action="store_true",
+                        help="Keep input order of files in packed output.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Transform only input files changed since "
+                             "the last run into the output directory.")
+    arguments = vars(parser.parse_args())
+    if arguments["incremental"] and _is_packed(arguments["output"]):
+        parser.error("--incremental requires an output directory.")
+    return arguments
 
 
 def main(arguments):
@@ -43,6 +72,9 @@ def _init_logging() -> None:
 
 
 def _create_directory(path: str) -> None:
+    if _is_packed(path):
+        # Packed output is a single file in the directory.
+        path = os.path.dirname(path)
     if path == "" or path == "." or path == "..":
         return
     os.makedirs(path, exist_ok=True)
@@ -51,9 +83,22 @@ def _create_directory(path: str) -> None:
 # endregion
 
 def refine_mapping(arguments):
+    # Classes of an entity depend only on the knowledge graph, so only
+    # entities of the files to transform are collected.
+    manifest, selected = _prepare_incremental(arguments, lambda: {
+        "transformer": "instance-to-class",
+        "sourceProperty": arguments["sourceProperty"],
+        "targetProperty": arguments["targetProperty"],
+        "knowledge": _hash_file(arguments["knowledge"]),
+    })
+    if selected is not None and not selected:
+        logging.info("No changed files, knowledge is not loaded.")
+        _save_manifest(arguments["output"], manifest)
+        return
     entities = _collect_entities(
-        arguments["input"], arguments["sourceProperty"])
-    mapping = _collect_mapping(entities, arguments["knowledge"])
+        arguments["input"], arguments["sourceProperty"], selected)
+    mapping = _collect_mapping(
+        entities, arguments["knowledge"], arguments["workers"])
     logging.info("Mapping size: %s", len(mapping))
     transitive_mapping = _create_transitive_mapping(mapping)
 
@@ -69,15 +114,20 @@ def refine_mapping(arguments):
         )
         return content
 
-    _transform_files(arguments["input"], arguments["output"], file_transformer)
+    _transform_files(
+        arguments["input"], arguments["output"], file_transformer,
+        arguments["workers"], arguments["ordered"], selected)
+    _save_manifest(arguments["output"], manifest)
 
 
-def _collect_entities(input_directory: str, source_property: str) \
+def _collect_entities(
+        input_directory: str, source_property: str,
+        selected: typing.Optional[typing.Set[str]] = None) \
         -> typing.Set[str]:
     result = set()
     logging.info("Collecting entities ...")
     index = 0
-    for index, _, content in _iterate_input_files(input_directory):
+    for index, _, content in _iterate_input_files(input_directory, selected):
         values, _ = _select_property(source_property, content)
         for value in values:
             result.add(value["id"])
@@ -89,32 +139,39 @@ def _collect_entities(input_directory: str, source_property: str) \
     return result
 
 
-def _collect_mapping(entities: typing.Set[str], knowledge_file: str) \
+def _collect_mapping(
+        entities: typing.Set[str], knowledge_file: str, workers: int = 1) \
         -> typing.Dict[str, str]:
     logging.info("Collecting mapping ... ")
     result = {}
     to_resolve = {key for key in entities}
     while len(to_resolve) > 0:
         mapping, new_to_resolve = _collect_from_hierarchy(
-            to_resolve, knowledge_file)
+            to_resolve, knowledge_file, workers)
         result.update(mapping)
         to_resolve = new_to_resolve
     logging.info("Collecting mapping ... done")
     return result
 
 
-def _collect_from_hierarchy(to_resolve: typing.Set[str], knowledge_file: str):
+def _collect_from_hierarchy(
+        to_resolve: typing.Set[str], knowledge_file: str, workers: int = 1):
     mapping = {}
     new_to_resolve = set()
     logging.info("Iterating the file with %s entities", len(to_resolve))
-    index = 0
-    for index, entity in _iterate_json_lines(knowledge_file):
-        if index % 5000000 == 0:
-            logging.info("    %s", index)
-        #
+
+    def select_entity(entity):
+        if entity["@id"] not in to_resolve:
+            return None
+        # Only the properties used below are sent back from the workers.
+        return {
+            key: entity[key]
+            for key in ("@id", "subclassOf", "instanceOf")
+            if key in entity
+        }
+
+    for entity in _scan_json_lines(knowledge_file, select_entity, workers):
         entity_id = entity["@id"]
-        if entity_id not in to_resolve:
-            continue
         if len(entity.get("subclassOf", [])) > 0:
             # If entity has subclassOf, we consider it to be a concept.
             mapping[entity_id] = [entity_id]
@@ -135,7 +192,6 @@ def _collect_from_hierarchy(to_resolve: typing.Set[str], knowledge_file: str):
             if instance_id in mapping:
                 continue
             new_to_resolve.add(instance_id)
-    logging.info("    %s", index)
     return mapping, new_to_resolve
 
 
@@ -198,12 +254,61 @@ def _transform_property(transitive_mapping, values):
 
 # region Knowledge graph
 
-def _iterate_json_lines(file_path: str) \
-        -> typing.Generator[typing.Tuple[int, typing.Dict], None, None]:
-    with open(file_path, encoding="utf-8") as stream:
-        for index, line in enumerate(stream):
-            entity = json.loads(line)
-            yield index, entity
+def _scan_json_lines(file_path: str, select, workers: int = 1):
+    """
+    Yield results of select called on every line of a JSON lines file, in
+    order of the file, None results are skipped. The file is split into
+    byte ranges aligned to lines, with more workers the ranges are parsed
+    and selected in parallel, only the selected results are sent back.
+    """
+    byte_ranges = _split_to_byte_ranges(file_path, SCAN_RANGE_SIZE)
+    size = os.path.getsize(file_path)
+    _WORKER["select"] = select
+    _WORKER["scan"] = file_path
+    scanned = 0
+    with contextlib.ExitStack() as stack:
+        if workers > 1:
+            context = multiprocessing.get_context("fork")
+            pool = stack.enter_context(context.Pool(workers))
+            results = pool.imap(_scan_byte_range, byte_ranges)
+        else:
+            # Results are not collected, so only one entity is kept.
+            results = map(_iterate_byte_range, byte_ranges)
+        for (start, end), selected in zip(byte_ranges, results):
+            yield from selected
+            scanned += end - start
+            logging.info("    %s of %s bytes", scanned, size)
+
+
+def _split_to_byte_ranges(file_path: str, range_size: int) \
+        -> typing.List[typing.Tuple[int, int]]:
+    size = os.path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, "rb") as stream:
+        while boundaries[-1] + range_size < size:
+            # Range ends with the line containing its last byte.
+            stream.seek(boundaries[-1] + range_size)
+            stream.readline()
+            boundaries.append(stream.tell())
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _scan_byte_range(byte_range: typing.Tuple[int, int]) -> typing.List:
+    return list(_iterate_byte_range(byte_range))
+
+
+def _iterate_byte_range(byte_range: typing.Tuple[int, int]):
+    start, end = byte_range
+    select = _WORKER["select"]
+    with open(_WORKER["scan"], "rb") as stream:
+        stream.seek(start)
+        content = stream.read(end - start)
+    for line in io.BytesIO(content):
+        selected = select(json.loads(line))
+        if selected is not None:
+            yield selected
 
 
 # endregion
@@ -241,28 +346,300 @@ def _select_property(
 
 
 def _transform_files(
-        input_directory: str, output_directory: str, transformer) -> None:
+        input_directory: str, output_directory: str, transformer,
+        workers: int = 1, ordered: bool = False,
+        selected: typing.Optional[typing.Set[str]] = None) -> None:
+    # Only selected files are transformed, all when selected is None.
+    if workers > 1:
+        _transform_files_parallel(
+            input_directory, output_directory, transformer, workers, ordered,
+            selected)
+    else:
+        _transform_files_sequential(
+            input_directory, output_directory, transformer, selected)
+
+
+def _transform_files_sequential(
+        input_directory: str, output_directory: str, transformer,
+        selected: typing.Optional[typing.Set[str]]) -> None:
     logging.info("Transforming files ...")
     index = 0
-    for index, file_name, content in _iterate_input_files(input_directory):
-        result = transformer(content)
-        output_file = os.path.join(output_directory, file_name)
-        with open(output_file, "w", encoding="utf-8") as stream:
-            json.dump(result, stream)
-        if index % 1000 == 0:
-            logging.info("    %s", index)
+    with _open_output_files(output_directory) as write_file:
+        for index, file_name, content in \
+                _iterate_input_files(input_directory, selected):
+            write_file(file_name, transformer(content))
+            if index % 1000 == 0:
+                logging.info("    %s", index)
     logging.info("    %s", index)
     logging.info("Transforming files ... done")
 
 
-def _iterate_input_files(input_directory: str):
-    for index, file_name in enumerate(os.listdir(input_directory)):
+def _transform_files_parallel(
+        input_directory: str, output_directory: str, transformer,
+        workers: int, ordered: bool,
+        selected: typing.Optional[typing.Set[str]]) -> None:
+    logging.info("Transforming files with %s workers ...", workers)
+    _WORKER["transformer"] = transformer
+    _WORKER["input"] = input_directory
+    _WORKER["output"] = output_directory
+    index = 0
+    context = multiprocessing.get_context("fork")
+    with _open_output_files(output_directory) as write_file, \
+            context.Pool(workers) as pool:
+        chunks = _iterate_input_chunks(input_directory, selected)
+        if ordered:
+            results = pool.imap(_transform_chunk, chunks)
+        else:
+            results = pool.imap_unordered(_transform_chunk, chunks)
+        for count, serialized in results:
+            # Only the packed output is written here, workers write files.
+            for file_name, text in serialized:
+                write_file(file_name, text, serialized=True)
+            if index // 1000 != (index + count) // 1000:
+                logging.info("    %s", index + count)
+            index += count
+    logging.info("    %s", index)
+    logging.info("Transforming files ... done")
+
+
+def _iterate_input_chunks(
+        input_directory: str,
+        selected: typing.Optional[typing.Set[str]] = None):
+    # File names, or lines of a packed input, in chunks of CHUNK_SIZE.
+    if _is_packed(input_directory):
+        yield from _split_to_chunks(
+            _iterate_packed_lines(input_directory, selected))
+    else:
+        yield from _split_to_chunks(
+            _select_file_names(input_directory, selected))
+
+
+def _split_to_chunks(items):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, CHUNK_SIZE))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def _transform_chunk(chunk):
+    serialized = []
+    for item in chunk:
+        if _is_packed(_WORKER["input"]):
+            file_name, content = json.loads(item)
+        else:
+            file_name = item
+            input_file = os.path.join(_WORKER["input"], file_name)
+            with open(input_file, "r", encoding="utf-8") as stream:
+                content = json.load(stream)
+        text = json.dumps(_WORKER["transformer"](content))
+        if _is_packed(_WORKER["output"]):
+            serialized.append((file_name, text))
+            continue
+        output_file = os.path.join(_WORKER["output"], file_name)
+        with open(output_file, "w", encoding="utf-8") as stream:
+            stream.write(text)
+    return len(chunk), serialized
+
+
+@contextlib.contextmanager
+def _open_output_files(output_path: str):
+    if not _is_packed(output_path):
+        def write_file(
+                file_name: str, content, serialized: bool = False) -> None:
+            output_file = os.path.join(output_path, file_name)
+            with open(output_file, "w", encoding="utf-8") as stream:
+                if serialized:
+                    stream.write(content)
+                else:
+                    json.dump(content, stream)
+
+        yield write_file
+        return
+    # Packed files are JSON lines "[file_name, content]", the offset index
+    # of the lines is stored next to them.
+    offsets = {}
+    position = 0
+    with open(output_path, "wb") as stream:
+        def write_file(
+                file_name: str, content, serialized: bool = False) -> None:
+            nonlocal position
+            if serialized:
+                # Same as json.dumps of the list with the parsed content.
+                line = "[" + json.dumps(file_name) + ", " + content + "]\n"
+            else:
+                line = json.dumps([file_name, content]) + "\n"
+            line = line.encode("utf-8")
+            stream.write(line)
+            offsets[file_name] = position
+            position += len(line)
+
+        yield write_file
+    with open(output_path + PACKED_INDEX_SUFFIX, "w", encoding="utf-8") \
+            as stream:
+        json.dump(offsets, stream)
+
+
+def _iterate_input_files(
+        input_directory: str,
+        selected: typing.Optional[typing.Set[str]] = None):
+    if _is_packed(input_directory):
+        lines = _iterate_packed_lines(input_directory, selected)
+        for index, line in enumerate(lines):
+            file_name, input_content = json.loads(line)
+            yield index, file_name, input_content
+        return
+    file_names = _select_file_names(input_directory, selected)
+    for index, file_name in enumerate(file_names):
         input_file = os.path.join(input_directory, file_name)
         with open(input_file, "r", encoding="utf-8") as stream:
             input_content = json.load(stream)
         yield index, file_name, input_content
 
 
+def _iterate_packed_lines(
+        input_path: str, selected: typing.Optional[typing.Set[str]]):
+    offsets = None if selected is None else _load_packed_index(input_path)
+    if offsets is None:
+        with open(input_path, "r", encoding="utf-8") as stream:
+            yield from _select_lines(stream, selected)
+        return
+    # Only the selected lines are read, in order of the pack.
+    with open(input_path, "rb") as stream:
+        for offset in sorted(
+                offsets[file_name] for file_name in selected
+                if file_name in offsets):
+            stream.seek(offset)
+            yield stream.readline().decode("utf-8")
+
+
+def _load_packed_index(input_path: str) \
+        -> typing.Optional[typing.Dict[str, int]]:
+    # The index is written after the pack, an older one is outdated.
+    index_path = input_path + PACKED_INDEX_SUFFIX
+    if not os.path.exists(index_path) or \
+            os.path.getmtime(index_path) < os.path.getmtime(input_path):
+        return None
+    with open(index_path, "r", encoding="utf-8") as stream:
+        return json.load(stream)
+
+
+def _select_lines(lines, selected: typing.Optional[typing.Set[str]]):
+    for line in lines:
+        if selected is None or _packed_file_name(line) in selected:
+            yield line
+
+
+def _select_file_names(
+        input_directory: str, selected: typing.Optional[typing.Set[str]]) \
+        -> typing.List[str]:
+    # Hidden files, like the manifest of an incremental run, are skipped.
+    return [
+        file_name for file_name in os.listdir(input_directory)
+        if not file_name.startswith(".")
+        and (selected is None or file_name in selected)
+    ]
+
+
+def _packed_file_name(line: str) -> str:
+    # Only the file name at the start of the line is decoded.
+    file_name, _ = json.JSONDecoder().raw_decode(line, 1)
+    return file_name
+
+
+def _is_packed(path: str) -> bool:
+    return path.endswith(PACKED_EXTENSION)
+
+
+# endregion
+
+# region Incremental
+
+def _prepare_incremental(arguments, parameters):
+    """
+    Return manifest and names of files to transform, or None and None when
+    the run is not incremental. The parameters function is called only for
+    incremental runs, its result must contain everything the transformation
+    of a file depends on, except the file itself.
+    """
+    if not arguments["incremental"]:
+        return None, None
+    manifest = _create_manifest(arguments["input"], parameters())
+    return manifest, _select_changed_files(arguments["output"], manifest)
+
+
+def _save_manifest(output_directory: str, manifest) -> None:
+    if manifest is None:
+        return
+    _save_json_file(os.path.join(output_directory, MANIFEST_FILE), manifest)
+
+
+def _create_manifest(input_directory: str, parameters):
+    logging.info("Computing input hashes ...")
+    files = {}
+    if _is_packed(input_directory):
+        with open(input_directory, "r", encoding="utf-8") as stream:
+            for line in stream:
+                files[_packed_file_name(line)] = \
+                    _hash_bytes(line.encode("utf-8"))
+    else:
+        for file_name in _select_file_names(input_directory, None):
+            input_file = os.path.join(input_directory, file_name)
+            with open(input_file, "rb") as stream:
+                files[file_name] = _hash_bytes(stream.read())
+    logging.info("Computing input hashes ... done")
+    return {
+        "parameters": _hash_bytes(
+            json.dumps(parameters, sort_keys=True).encode("utf-8")),
+        "files": files,
+    }
+
+
+def _select_changed_files(output_directory: str, manifest) \
+        -> typing.Set[str]:
+    manifest_file = os.path.join(output_directory, MANIFEST_FILE)
+    previous = {"parameters": None, "files": {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as stream:
+            previous = json.load(stream)
+    # Outputs of deleted input files are removed.
+    for file_name in previous["files"]:
+        output_file = os.path.join(output_directory, file_name)
+        if file_name not in manifest["files"] \
+                and os.path.exists(output_file):
+            os.remove(output_file)
+    if previous["parameters"] != manifest["parameters"]:
+        logging.info("Parameters changed, transforming all files.")
+        return set(manifest["files"].keys())
+    selected = {
+        file_name
+        for file_name, file_hash in manifest["files"].items()
+        if previous["files"].get(file_name) != file_hash
+        or not os.path.exists(os.path.join(output_directory, file_name))
+    }
+    logging.info(
+        "Changed files: %s of %s", len(selected), len(manifest["files"]))
+    return selected
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hash_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def _save_json_file(path: str, content) -> None:
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+
+
 # endregion
 
 if __name__ == "__main__":
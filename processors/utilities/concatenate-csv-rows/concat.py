@@ -3,8 +3,16 @@
 
 import argparse
 import logging
-import csv
 import os
+import heapq
+import tempfile
+import itertools
+
+from descriptor_store import read_rows, open_writer
+
+
+RUN_SIZE = 100000
+
 
 def main():
   logging.basicConfig(
@@ -18,6 +26,14 @@ def main():
     logging.warning("Existing output CSV file cannot be overrided.")
     return 0
 
+  if args["grouped"] or args["external_sort"]:
+    logging.info("Streaming descriptors into file %s ... [from %s]" % (args["output"], args["input"]))
+    if not stream_descriptors(args["input"], args["header"], args["output"], args["rewrite"], args["external_sort"]):
+      logging.error("Error occured during descriptors streaming.")
+      return 1
+    logging.info("Finished ...")
+    return 0
+
   logging.info("Loading and merging descriptors ... [from %s]" % args["input"])
   descriptors = load_descriptors(args["input"], args["header"])
 
@@ -47,6 +63,12 @@ def read_configuration():
   parser.add_argument("--header",
     action="store_true", dest="header", required=False, default=False,
     help="Determines if the input CSV file has header.")
+  parser.add_argument("--grouped",
+    action="store_true", dest="grouped", required=False, default=False,
+    help="Rows with the same ID are consecutive in the input CSV file, stream them.")
+  parser.add_argument("--external-sort",
+    action="store_true", dest="external_sort", required=False, default=False,
+    help="Sort the input CSV file on disk first, then stream it.")
 
   parser.add_argument("-o", "--out", "--output",
     type=str, dest="output", required=True,
@@ -64,19 +86,48 @@ def load_descriptors(descriptors_path, header):
   if not valid_file_for_read(descriptors_path):
     return None
   
-  with open(descriptors_path, encoding="UTF-8") as input_stream:
-    reader = csv.reader(input_stream)
+  descriptors = {}
+  for row in read_rows(descriptors_path, header):
+    if not row[0] in descriptors:
+      descriptors[row[0]] = []
+    descriptors[row[0]].extend(row[1:])
+  return descriptors
+
+
+def stream_descriptors(descriptors_path, header, output_path, rewrite, external_sort=False):
+  if not valid_file_for_read(descriptors_path):
+    return False
+  if not valid_file_for_write(output_path, rewrite):
+    return False
+
+  with tempfile.TemporaryDirectory() as runs_directory, open_writer(output_path) as writer:
+    rows = read_rows(descriptors_path, header)
+    if external_sort:
+      rows = sort_rows(rows, runs_directory)
+    # Every ID is written as soon as its run of rows ends.
+    for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+      values = []
+      for row in group:
+        values.extend(row[1:])
+      writer.writerow( [ key ] + values )
+  return True
 
-    if header:
-      logging.debug("Skipping header info ...")
-      next(reader, None)
 
-    descriptors = {}
-    for row in reader:
-      if not row[0] in descriptors:
-        descriptors[row[0]] = []
-      descriptors[row[0]].extend(row[1:])
-    return descriptors
+def sort_rows(rows, runs_directory):
+  # External merge sort, sorted runs of at most RUN_SIZE rows are written
+  # into temporary files and merged. Both steps are stable, so values of
+  # the same ID keep their order.
+  runs = []
+  while True:
+    run = list(itertools.islice(rows, RUN_SIZE))
+    if len(run) == 0:
+      break
+    run.sort(key=lambda row: row[0])
+    run_path = os.path.join(runs_directory, "%s.dstore" % len(runs))
+    with open_writer(run_path) as run_writer:
+      run_writer.writerows(run)
+    runs.append(run_path)
+  return heapq.merge(*[ read_rows(run_path) for run_path in runs ], key=lambda row: row[0])
 
 
 def valid_file_for_read(file_path):
@@ -91,8 +142,7 @@ def save_descriptors(descriptors_path, rewrite, descriptors):
   if not valid_file_for_write(descriptors_path, rewrite):
     return False
   
-  with open(descriptors_path, "w", encoding="UTF-8", newline='') as output_stream:
-    writer = csv.writer(output_stream)
+  with open_writer(descriptors_path) as writer:
     for d in descriptors:
       writer.writerow( [ d ] + descriptors[d] )
     return True
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import logging
+import typing
+import argparse
+import contextlib
+
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_SUFFIX = ".index.json"
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True,
+                        help="Path to input directory or .jsonl pack.")
+    parser.add_argument("--output", required=True,
+                        help="Path to output directory or .jsonl pack.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    _init_logging()
+    _create_directory(arguments["output"])
+    _transform_files(arguments["input"], arguments["output"], lambda x: x)
+
+
+# region Utils
+
+def _init_logging() -> None:
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S")
+
+
+def _create_directory(path: str) -> None:
+    if _is_packed(path):
+        # Packed output is a single file in the directory.
+        path = os.path.dirname(path)
+    if path == "" or path == "." or path == "..":
+        return
+    os.makedirs(path, exist_ok=True)
+
+
+# endregion
+
+# region Transformation
+
+def _transform_files(
+        input_directory: str, output_directory: str, transformer) -> None:
+    logging.info("Transforming files ...")
+    index = 0
+    with _open_output_files(output_directory) as write_file:
+        for index, file_name, content in \
+                _iterate_input_files(input_directory):
+            write_file(file_name, transformer(content))
+            if index % 1000 == 0:
+                logging.info("    %s", index)
+    logging.info("    %s", index)
+    logging.info("Transforming files ... done")
+
+
+@contextlib.contextmanager
+def _open_output_files(output_path: str):
+    if not _is_packed(output_path):
+        def write_file(file_name: str, content) -> None:
+            output_file = os.path.join(output_path, file_name)
+            with open(output_file, "w", encoding="utf-8") as stream:
+                json.dump(content, stream)
+
+        yield write_file
+        return
+    # Packed files are JSON lines "[file_name, content]", the offset index
+    # of the lines is stored next to them.
+    offsets = {}
+    position = 0
+    with open(output_path, "wb") as stream:
+        def write_file(file_name: str, content) -> None:
+            nonlocal position
+            line = (json.dumps([file_name, content]) + "\n").encode("utf-8")
+            stream.write(line)
+            offsets[file_name] = position
+            position += len(line)
+
+        yield write_file
+    with open(output_path + PACKED_INDEX_SUFFIX, "w", encoding="utf-8") \
+            as stream:
+        json.dump(offsets, stream)
+
+
+def _iterate_input_files(input_directory: str):
+    if _is_packed(input_directory):
+        with open(input_directory, "r", encoding="utf-8") as stream:
+            for index, line in enumerate(stream):
+                file_name, input_content = json.loads(line)
+                yield index, file_name, input_content
+        return
+    for index, file_name in enumerate(_list_input_files(input_directory)):
+        input_file = os.path.join(input_directory, file_name)
+        with open(input_file, "r", encoding="utf-8") as stream:
+            input_content = json.load(stream)
+        yield index, file_name, input_content
+
+
+def _list_input_files(input_directory: str) -> typing.List[str]:
+    # Hidden files, like the manifest of an incremental run, are skipped.
+    return [
+        file_name for file_name in os.listdir(input_directory)
+        if not file_name.startswith(".")
+    ]
+
+
+def _is_packed(path: str) -> bool:
+    return path.endswith(PACKED_EXTENSION)
+
+
+# endregion
+
+if __name__ == "__main__":
+    main(_parse_arguments())
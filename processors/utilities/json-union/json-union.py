@@ -6,22 +6,53 @@ import os
 import logging
 import typing
 import argparse
+import contextlib
+import hashlib
+import multiprocessing
 import itertools
 import collections
 
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_SUFFIX = ".index.json"
+
+MANIFEST_FILE = ".manifest.json"
+
+# Number of input files transformed by a worker in one task.
+CHUNK_SIZE = 100
+
+# Transformer and paths inherited by the forked workers, the transformer
+# is a closure over the loaded data, so it is never pickled.
+_WORKER = {}
+
 
 def _parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True,
-                        help="Path to input descriptor directory.")
+                        help="Path to input directory or .jsonl pack.")
     parser.add_argument("--output", required=True,
-                        help="Path to output descriptor directory.")
+                        help="Path to output directory or .jsonl pack.")
     parser.add_argument("--sourceProperty", required=True,
-                        help="Name of a source properties to union.",
-                        metavar="S", nargs="+", type=str)
+                        help="Name of a source properties to union, "
+                             "can be repeated for more unions.",
+                        metavar="S", nargs="+", type=str, action="append")
     parser.add_argument("--targetProperty", required=True,
-                        help="Name of a property to store result into.")
-    return vars(parser.parse_args())
+                        help="Name of a property to store result into, "
+                             "one for each --sourceProperty.",
+                        action="append")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument("--ordered", action="store_true",
+                        help="Keep input order of files in packed output.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Transform only input files changed since "
+                             "the last run into the output directory.")
+    arguments = vars(parser.parse_args())
+    if arguments["incremental"] and _is_packed(arguments["output"]):
+        parser.error("--incremental requires an output directory.")
+    if len(arguments["sourceProperty"]) != len(arguments["targetProperty"]):
+        parser.error(
+            "Each --sourceProperty requires one --targetProperty.")
+    return arguments
 
 
 def main(arguments):
@@ -40,6 +71,9 @@ def _init_logging() -> None:
 
 
 def _create_directory(path: str) -> None:
+    if _is_packed(path):
+        # Packed output is a single file in the directory.
+        path = os.path.dirname(path)
     if path == "" or path == "." or path == "..":
         return
     os.makedirs(path, exist_ok=True)
@@ -48,28 +82,47 @@ def _create_directory(path: str) -> None:
 # endregion
 
 def union_properties(arguments):
+    # All unions are done in one pass, in the given order, so a union can
+    # use a result of the previous one.
+    unions = list(zip(
+        arguments["sourceProperty"], arguments["targetProperty"]))
+
     def transform_file(content):
-        result_data = []
-        result_metadata = []
-        for source_property in arguments["sourceProperty"]:
-            property_values, property_metadata = \
-                _select_property(source_property, content)
-            result_data.extend(property_values)
-            result_metadata.append(property_metadata)
-        content[arguments["targetProperty"]] = {
-            "data": result_data,
-            "metadata": [{
-                "transformer": "json-union",
-                "joined": result_metadata
-            }]
-        }
+        for source_properties, target_property in unions:
+            _union_property(source_properties, target_property, content)
         return content
 
-    _transform_files(arguments["input"], arguments["output"], transform_file)
+    manifest, selected = _prepare_incremental(arguments, lambda: {
+        "transformer": "json-union",
+        "unions": unions,
+    })
+    _transform_files(
+        arguments["input"], arguments["output"], transform_file,
+        arguments["workers"], arguments["ordered"], selected)
+    _save_manifest(arguments["output"], manifest)
 
 
 # region Transformation
 
+def _union_property(
+        source_properties: typing.List[str], target_property: str,
+        content) -> None:
+    result_data = []
+    result_metadata = []
+    for source_property in source_properties:
+        property_values, property_metadata = \
+            _select_property(source_property, content)
+        result_data.extend(property_values)
+        result_metadata.append(property_metadata)
+    content[target_property] = {
+        "data": result_data,
+        "metadata": [{
+            "transformer": "json-union",
+            "joined": result_metadata
+        }]
+    }
+
+
 def _select_property(
         source_property: str, content) \
         -> typing.Tuple[typing.List, typing.List]:
@@ -89,28 +142,292 @@ def _select_property(
 
 
 def _transform_files(
-        input_directory: str, output_directory: str, transformer) -> None:
+        input_directory: str, output_directory: str, transformer,
+        workers: int = 1, ordered: bool = False,
+        selected: typing.Optional[typing.Set[str]] = None) -> None:
+    # Only selected files are transformed, all when selected is None.
+    if workers > 1:
+        _transform_files_parallel(
+            input_directory, output_directory, transformer, workers, ordered,
+            selected)
+    else:
+        _transform_files_sequential(
+            input_directory, output_directory, transformer, selected)
+
+
+def _transform_files_sequential(
+        input_directory: str, output_directory: str, transformer,
+        selected: typing.Optional[typing.Set[str]]) -> None:
     logging.info("Transforming files ...")
     index = 0
-    for index, file_name, content in _iterate_input_files(input_directory):
-        result = transformer(content)
-        output_file = os.path.join(output_directory, file_name)
-        with open(output_file, "w", encoding="utf-8") as stream:
-            json.dump(result, stream)
-        if index % 1000 == 0:
-            logging.info("    %s", index)
+    with _open_output_files(output_directory) as write_file:
+        for index, file_name, content in \
+                _iterate_input_files(input_directory, selected):
+            write_file(file_name, transformer(content))
+            if index % 1000 == 0:
+                logging.info("    %s", index)
+    logging.info("    %s", index)
+    logging.info("Transforming files ... done")
+
+
+def _transform_files_parallel(
+        input_directory: str, output_directory: str, transformer,
+        workers: int, ordered: bool,
+        selected: typing.Optional[typing.Set[str]]) -> None:
+    logging.info("Transforming files with %s workers ...", workers)
+    _WORKER["transformer"] = transformer
+    _WORKER["input"] = input_directory
+    _WORKER["output"] = output_directory
+    index = 0
+    context = multiprocessing.get_context("fork")
+    with _open_output_files(output_directory) as write_file, \
+            context.Pool(workers) as pool:
+        chunks = _iterate_input_chunks(input_directory, selected)
+        if ordered:
+            results = pool.imap(_transform_chunk, chunks)
+        else:
+            results = pool.imap_unordered(_transform_chunk, chunks)
+        for count, serialized in results:
+            # Only the packed output is written here, workers write files.
+            for file_name, text in serialized:
+                write_file(file_name, text, serialized=True)
+            if index // 1000 != (index + count) // 1000:
+                logging.info("    %s", index + count)
+            index += count
     logging.info("    %s", index)
     logging.info("Transforming files ... done")
 
 
-def _iterate_input_files(input_directory: str):
-    for index, file_name in enumerate(os.listdir(input_directory)):
+def _iterate_input_chunks(
+        input_directory: str,
+        selected: typing.Optional[typing.Set[str]] = None):
+    # File names, or lines of a packed input, in chunks of CHUNK_SIZE.
+    if _is_packed(input_directory):
+        yield from _split_to_chunks(
+            _iterate_packed_lines(input_directory, selected))
+    else:
+        yield from _split_to_chunks(
+            _select_file_names(input_directory, selected))
+
+
+def _split_to_chunks(items):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, CHUNK_SIZE))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def _transform_chunk(chunk):
+    serialized = []
+    for item in chunk:
+        if _is_packed(_WORKER["input"]):
+            file_name, content = json.loads(item)
+        else:
+            file_name = item
+            input_file = os.path.join(_WORKER["input"], file_name)
+            with open(input_file, "r", encoding="utf-8") as stream:
+                content = json.load(stream)
+        text = json.dumps(_WORKER["transformer"](content))
+        if _is_packed(_WORKER["output"]):
+            serialized.append((file_name, text))
+            continue
+        output_file = os.path.join(_WORKER["output"], file_name)
+        with open(output_file, "w", encoding="utf-8") as stream:
+            stream.write(text)
+    return len(chunk), serialized
+
+
+@contextlib.contextmanager
+def _open_output_files(output_path: str):
+    if not _is_packed(output_path):
+        def write_file(
+                file_name: str, content, serialized: bool = False) -> None:
+            output_file = os.path.join(output_path, file_name)
+            with open(output_file, "w", encoding="utf-8") as stream:
+                if serialized:
+                    stream.write(content)
+                else:
+                    json.dump(content, stream)
+
+        yield write_file
+        return
+    # Packed files are JSON lines "[file_name, content]", the offset index
+    # of the lines is stored next to them.
+    offsets = {}
+    position = 0
+    with open(output_path, "wb") as stream:
+        def write_file(
+                file_name: str, content, serialized: bool = False) -> None:
+            nonlocal position
+            if serialized:
+                # Same as json.dumps of the list with the parsed content.
+                line = "[" + json.dumps(file_name) + ", " + content + "]\n"
+            else:
+                line = json.dumps([file_name, content]) + "\n"
+            line = line.encode("utf-8")
+            stream.write(line)
+            offsets[file_name] = position
+            position += len(line)
+
+        yield write_file
+    with open(output_path + PACKED_INDEX_SUFFIX, "w", encoding="utf-8") \
+            as stream:
+        json.dump(offsets, stream)
+
+
+def _iterate_input_files(
+        input_directory: str,
+        selected: typing.Optional[typing.Set[str]] = None):
+    if _is_packed(input_directory):
+        lines = _iterate_packed_lines(input_directory, selected)
+        for index, line in enumerate(lines):
+            file_name, input_content = json.loads(line)
+            yield index, file_name, input_content
+        return
+    file_names = _select_file_names(input_directory, selected)
+    for index, file_name in enumerate(file_names):
         input_file = os.path.join(input_directory, file_name)
         with open(input_file, "r", encoding="utf-8") as stream:
             input_content = json.load(stream)
         yield index, file_name, input_content
 
 
+def _iterate_packed_lines(
+        input_path: str, selected: typing.Optional[typing.Set[str]]):
+    offsets = None if selected is None else _load_packed_index(input_path)
+    if offsets is None:
+        with open(input_path, "r", encoding="utf-8") as stream:
+            yield from _select_lines(stream, selected)
+        return
+    # Only the selected lines are read, in order of the pack.
+    with open(input_path, "rb") as stream:
+        for offset in sorted(
+                offsets[file_name] for file_name in selected
+                if file_name in offsets):
+            stream.seek(offset)
+            yield stream.readline().decode("utf-8")
+
+
+def _load_packed_index(input_path: str) \
+        -> typing.Optional[typing.Dict[str, int]]:
+    # The index is written after the pack, an older one is outdated.
+    index_path = input_path + PACKED_INDEX_SUFFIX
+    if not os.path.exists(index_path) or \
+            os.path.getmtime(index_path) < os.path.getmtime(input_path):
+        return None
+    with open(index_path, "r", encoding="utf-8") as stream:
+        return json.load(stream)
+
+
+def _select_lines(lines, selected: typing.Optional[typing.Set[str]]):
+    for line in lines:
+        if selected is None or _packed_file_name(line) in selected:
+            yield line
+
+
+def _select_file_names(
+        input_directory: str, selected: typing.Optional[typing.Set[str]]) \
+        -> typing.List[str]:
+    # Hidden files, like the manifest of an incremental run, are skipped.
+    return [
+        file_name for file_name in os.listdir(input_directory)
+        if not file_name.startswith(".")
+        and (selected is None or file_name in selected)
+    ]
+
+
+def _packed_file_name(line: str) -> str:
+    # Only the file name at the start of the line is decoded.
+    file_name, _ = json.JSONDecoder().raw_decode(line, 1)
+    return file_name
+
+
+def _is_packed(path: str) -> bool:
+    return path.endswith(PACKED_EXTENSION)
+
+
+# endregion
+
+# region Incremental
+
+def _prepare_incremental(arguments, parameters):
+    """
+    Return manifest and names of files to transform, or None and None when
+    the run is not incremental. The parameters function is called only for
+    incremental runs, its result must contain everything the transformation
+    of a file depends on, except the file itself.
+    """
+    if not arguments["incremental"]:
+        return None, None
+    manifest = _create_manifest(arguments["input"], parameters())
+    return manifest, _select_changed_files(arguments["output"], manifest)
+
+
+def _save_manifest(output_directory: str, manifest) -> None:
+    if manifest is None:
+        return
+    _save_json_file(os.path.join(output_directory, MANIFEST_FILE), manifest)
+
+
+def _create_manifest(input_directory: str, parameters):
+    logging.info("Computing input hashes ...")
+    files = {}
+    if _is_packed(input_directory):
+        with open(input_directory, "r", encoding="utf-8") as stream:
+            for line in stream:
+                files[_packed_file_name(line)] = \
+                    _hash_bytes(line.encode("utf-8"))
+    else:
+        for file_name in _select_file_names(input_directory, None):
+            input_file = os.path.join(input_directory, file_name)
+            with open(input_file, "rb") as stream:
+                files[file_name] = _hash_bytes(stream.read())
+    logging.info("Computing input hashes ... done")
+    return {
+        "parameters": _hash_bytes(
+            json.dumps(parameters, sort_keys=True).encode("utf-8")),
+        "files": files,
+    }
+
+
+def _select_changed_files(output_directory: str, manifest) \
+        -> typing.Set[str]:
+    manifest_file = os.path.join(output_directory, MANIFEST_FILE)
+    previous = {"parameters": None, "files": {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as stream:
+            previous = json.load(stream)
+    # Outputs of deleted input files are removed.
+    for file_name in previous["files"]:
+        output_file = os.path.join(output_directory, file_name)
+        if file_name not in manifest["files"] \
+                and os.path.exists(output_file):
+            os.remove(output_file)
+    if previous["parameters"] != manifest["parameters"]:
+        logging.info("Parameters changed, transforming all files.")
+        return set(manifest["files"].keys())
+    selected = {
+        file_name
+        for file_name, file_hash in manifest["files"].items()
+        if previous["files"].get(file_name) != file_hash
+        or not os.path.exists(os.path.join(output_directory, file_name))
+    }
+    logging.info(
+        "Changed files: %s of %s", len(selected), len(manifest["files"]))
+    return selected
+
+
+def _hash_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def _save_json_file(path: str, content) -> None:
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+
+
 # endregion
 
 if __name__ == "__main__":
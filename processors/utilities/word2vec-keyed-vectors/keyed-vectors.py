@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+import logging
+
+from gensim.models import Word2Vec
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] - %(message)s",
+    datefmt="%H:%M:%S")
+  
+  args = read_configuration()
+
+  if not valid_file_for_write(args["output"], args["rewrite"]):
+    logging.warning("Existing output file [%s] cannot be overrided." % args["output"])
+    return 0
+
+  if not valid_file_for_read(args["model"]):
+    logging.error("Model file [%s] does not exist." % args["model"])
+    return 1
+
+  logging.info("Loading Word2Vec model ... [from %s]" % args["model"])
+  model = Word2Vec.load(args["model"])
+  if not model:
+    logging.error("Model cannot be loaded.")
+    return 2
+
+  logging.info("Saving keyed vectors ... [to %s]" % args["output"])
+  # The vectors are always stored in a separate .npy file, so they can be
+  # memory-mapped by the consumers regardless of the model size.
+  model.wv.save(args["output"], separately=["vectors"])
+
+  logging.info("Finished ...")
+  return 0
+
+
+def read_configuration():
+  parser = argparse.ArgumentParser(
+    description="Extract keyed vectors from a full Word2Vec model.")
+  
+  parser.add_argument("-m", "--model",
+    type=str, dest="model", required=True,
+    help="Path to Word2Vec model.")
+
+  parser.add_argument("-o", "--out", "--output",
+    type=str, dest="output", required=True,
+    help="Path to output keyed vectors file.")
+  parser.add_argument("--rewrite",
+    action="store_true", dest="rewrite", required=False, default=False,
+    help="Rewrite existing output file.")
+  
+  args = vars(parser.parse_args())
+
+  return args
+
+
+def valid_file_for_read(file_path):
+  if not os.path.exists(file_path):
+    return False
+  if not os.path.isfile(file_path):
+    return False
+  return True
+
+
+def valid_file_for_write(file_path, rewrite = False):
+  if not os.path.exists(file_path):
+    return True
+  if not os.path.isfile(file_path):
+    return False
+  if rewrite:
+    return True
+  return False
+
+
+if __name__ == "__main__":
+  exit(main())